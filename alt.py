@@ -149,7 +149,7 @@ class Alt:
             return
         for color in Color:
             for opening_stage in OpeningStage:
-                wait_s = mod.api.get_waiting_time(ApiType.InsightsRefresh)
+                wait_s = mod.api.get_waiting_time(ApiType.InsightsRefresh, mod.token)
                 to_refresh = needs_to_refresh_insights(self.user.id, now) and (wait_s <= 0)
                 self.hist_openings[color][opening_stage] = download_openings(self.user.id, color, opening_stage, mod,
                                                                              to_refresh)
@@ -391,7 +391,7 @@ class Alts:
                 if self.is_mod_log:
                     self.is_mod_log = alt.download_mod_log(mod)
             alt.download_openings(force_refresh_openings, mod)
-        self.wait_insights_refresh_s = mod.api.get_waiting_time(ApiType.InsightsRefresh)
+        self.wait_insights_refresh_s = mod.api.get_waiting_time(ApiType.InsightsRefresh, mod.token)
         self.is_step1 = True
 
     def process_step2(self, mod):
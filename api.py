@@ -1,40 +1,61 @@
 import httpx
 import json
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 import time
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from dateutil import tz
 import traceback
 import os
-from threading import Lock
-from consts import API_TOURNEY_PAGE_DELAY, VERBOSE
+import asyncio
+from threading import Lock, Thread, Condition, Event
+from contextlib import contextmanager
+from concurrent.futures import as_completed
+from consts import API_TOURNEY_PAGE_DELAY, API_CACHE_TTL, API_CACHE_SIZE, API_RETRY_AFTER, API_ERROR_PAUSE, \
+    API_MAX_DELAY_FACTOR, API_DELAY_RECOVERY, API_MAX_CLIENTS, API_CLIENT_IDLE_TIMEOUT, VERBOSE
+from metrics import API_QUEUE_WAIT, API_LATENCY, API_RESPONSE_SIZE, API_RESPONSES, API_RETRIES, API_THROTTLED, \
+    API_ERRORS, API_CACHE, NDJSON_QUEUE_WAIT
+
+
+LICHESS_URL = os.getenv("LICHESS_URL", "").rstrip('/')
+
+
+def get_url(url):
+    # LICHESS_URL points all requests to another server, e.g. the local stand-in fake_lichess.py
+    if LICHESS_URL:
+        if url.startswith("https://lichess.org"):
+            return f"{LICHESS_URL}{url[19:]}"
+        if url.startswith("https://explorer.lichess.ovh"):
+            return f"{LICHESS_URL}/explorer{url[28:]}"
+    return url
 
 
 class Endpoint:
-    def __init__(self, name, delay=1.0, num_requests=1):
+    def __init__(self, name, delay=1.0, num_requests=1, ttl=0, is_public=False):
         self.name = name
         self.delay = delay
         self.num_requests = num_requests
-        self.lock = Lock()
+        self.ttl = ttl  # [s] successful GET responses are reused for `ttl` seconds, 0: not cached
+        self.is_public = is_public  # the response doesn't depend on the token, so it can be shared by all mods
 
 
 class ApiType:
     # Get
     ApiAccount = Endpoint('api/account')
-    ApiUser = Endpoint('api/user')
-    ApiUserNote = Endpoint('api/user/note')
-    ApiUserModLog = Endpoint('api/user/mod-log')
+    ApiUser = Endpoint('api/user', ttl=API_CACHE_TTL)
+    ApiUserNote = Endpoint('api/user/note', ttl=API_CACHE_TTL)
+    ApiUserModLog = Endpoint('api/user/mod-log', ttl=API_CACHE_TTL)
     ApiUsersStatus = Endpoint('api/users/status')
-    ModChatUser = Endpoint('mod/chat-user')
+    ModChatUser = Endpoint('mod/chat-user', ttl=API_CACHE_TTL)
     ReportListBoost = Endpoint('report/list/boost')
     ApiTeamOf = Endpoint('api/team/of')
     AtUsernameFollowing = Endpoint('@/username/following')
-    ApiTournamentId = Endpoint('api/tournament/id')
-    ApiSwiss = Endpoint('api/swiss')
+    ApiTournamentId = Endpoint('api/tournament/id', ttl=API_CACHE_TTL, is_public=True)
+    ApiSwiss = Endpoint('api/swiss', ttl=API_CACHE_TTL, is_public=True)
     ApiTournament = Endpoint('api/tournament')
-    TournamentId = Endpoint('tournament', API_TOURNEY_PAGE_DELAY)
+    TournamentId = Endpoint('tournament', API_TOURNEY_PAGE_DELAY, is_public=True)
     ApiRoomChat = Endpoint('/api/room/chat', API_TOURNEY_PAGE_DELAY)
-    PlayerTop = Endpoint('player/top')
+    PlayerTop = Endpoint('player/top', ttl=API_CACHE_TTL, is_public=True)
     ExplorerLichess = Endpoint('explorer/lichess', 2.0)
     # Get ndjson
     ApiGamesUser = Endpoint('api/games/user')
@@ -64,64 +85,394 @@ MAX_REQUESTS_PER_CONNECTION = 500  # server limit: 1000/2000
 MAX_RETRIES = 2
 
 
+class Connection:
+    def __init__(self, httpx_client):
+        self.httpx = httpx_client
+        self.num_requests = 0
+        self.num_active = 0
+
+
 class Client:
+    # The connection is replaced after MAX_REQUESTS_PER_CONNECTION requests or an error. The old one is closed
+    # once the requests still using it are finished, so they are never interrupted.
     def __init__(self):
         self.client_lock = Lock()
+        self.connection = Connection(self.create())
+        self.last_used = time.monotonic()
+        self.is_closed = False
+
+    @staticmethod
+    def create():
         transport = httpx.HTTPTransport(retries=5, http2=True)
         transport._pool._max_streams = MAX_REQUESTS_PER_CONNECTION
         timeout = httpx.Timeout(60.0, connect=5.0)
-        self.httpx = httpx.Client(transport=transport, timeout=timeout)
-        self.request_counter = 0
+        return httpx.Client(transport=transport, timeout=timeout)
 
-    def check(self, force_restart=False):
-        if force_restart:
+    def close_connection(self, connection):
+        connection.httpx.close()
+
+    def acquire(self):
+        # None if the client has been closed after ClientPool.get(), see ClientPool.use()
+        old_connection = None
+        with self.client_lock:
+            if self.is_closed:
+                return None
+            if self.connection.num_requests >= MAX_REQUESTS_PER_CONNECTION:
+                old_connection = self.connection
+                self.connection = Connection(self.create())
+            connection = self.connection
+            connection.num_requests += 1
+            connection.num_active += 1
+            self.last_used = time.monotonic()
+        if old_connection and old_connection.num_active == 0:
+            self.close_connection(old_connection)
+        return connection
+
+    def release(self, connection):
+        with self.client_lock:
+            connection.num_active -= 1
+            self.last_used = time.monotonic()
+            to_close = connection.num_active == 0 and (connection is not self.connection or self.is_closed)
+        if to_close:
+            self.close_connection(connection)
+
+    def restart(self, connection):
+        # Several requests may fail on the same connection: only the first one replaces it
+        with self.client_lock:
+            if connection is not self.connection or self.is_closed:
+                return
             print(f"Restarting connection: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f}")
+            self.connection = Connection(self.create())
+            to_close = connection.num_active == 0
+        if to_close:
+            self.close_connection(connection)
+
+    def is_idle(self, now, idle_timeout):
+        return self.connection.num_active == 0 and now - self.last_used >= idle_timeout
+
+    def close(self):
         with self.client_lock:
-            if force_restart or (self.request_counter >= MAX_REQUESTS_PER_CONNECTION):
-                self.httpx.close()
-                transport = httpx.HTTPTransport(retries=5, http2=True)
-                transport._pool._max_streams = MAX_REQUESTS_PER_CONNECTION
-                timeout = httpx.Timeout(60.0, connect=5.0)
-                self.httpx = httpx.Client(transport=transport, timeout=timeout)
-                self.request_counter = 0
+            self.is_closed = True
+            to_close = self.connection.num_active == 0
+        if to_close:
+            self.close_connection(self.connection)
 
-    def restart(self):
-        self.check(force_restart=True)
+
+class AsyncClient(Client):
+    # The lock is never held across an await, so the same bookkeeping works for the coroutines of the event loop
+    @staticmethod
+    def create():
+        transport = httpx.AsyncHTTPTransport(retries=5, http2=True)
+        timeout = httpx.Timeout(60.0, connect=5.0)
+        return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+    def close_connection(self, connection):
+        asyncio.run_coroutine_threadsafe(connection.httpx.aclose(), EventLoop.get())
+
+
+class ClientPool:
+    # Clients by token: the least recently used ones are closed when there are more than `max_size` of them,
+    # and so are the clients idle for `idle_timeout` seconds.
+    def __init__(self, client_type, max_size=API_MAX_CLIENTS, idle_timeout=API_CLIENT_IDLE_TIMEOUT):
+        self.client_type = client_type
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        self.clients = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                client = self.client_type()
+                self.clients[key] = client
+            else:
+                self.clients.move_to_end(key)
+                client.last_used = time.monotonic()
+            evicted = []
+            while len(self.clients) > self.max_size:
+                evicted.append(self.clients.popitem(last=False)[1])
+            now = time.monotonic()
+            while self.clients:
+                key_lru, client_lru = next(iter(self.clients.items()))
+                if not client_lru.is_idle(now, self.idle_timeout):
+                    break
+                evicted.append(client_lru)
+                del self.clients[key_lru]
+        for client_evicted in evicted:
+            client_evicted.close()
+        if evicted and VERBOSE >= 3:
+            print(f"Closed {len(evicted)} HTTP client(s), {len(self.clients)} left")
+        return client
+
+    @contextmanager
+    def use(self, key):
+        # Another thread can evict and close the client between get() and acquire(): a new one is taken then
+        connection = None
+        while connection is None:
+            client = self.get(key)
+            connection = client.acquire()
+        try:
+            yield client, connection
+        finally:
+            client.release(connection)
+
+    def __len__(self):
+        return len(self.clients)
+
+
+class EventLoop:
+    # A single background event loop shared by all AsyncApi instances, so that synchronous code
+    # (waitress workers, the chat loop) can run a batch of requests concurrently and wait for the results.
+    lock = Lock()
+    loop: asyncio.AbstractEventLoop = None
+
+    @staticmethod
+    def get():
+        with EventLoop.lock:
+            if EventLoop.loop is None:
+                loop = asyncio.new_event_loop()
+                Thread(name="api_loop", target=loop.run_forever, daemon=True).start()
+                EventLoop.loop = loop
+            return EventLoop.loop
+
+
+class RateLimiter:
+    # Leaky bucket per endpoint: at most `num_requests` send slots within any `delay` seconds.
+    # A single limiter is shared by all Api and AsyncApi instances, i.e. by all mods.
+    # The budget of a public endpoint is shared by all mods, other endpoints have a budget per token.
+    # Slots are reserved under a short lock; callers wait for their slot without holding it.
+    # After a 429 or an error, the endpoint is paused and its delay is widened, then narrowed back on success.
+    # Other endpoints are never affected.
+    def __init__(self):
+        self.lock = Lock()
+        self.slots = defaultdict(deque)
+        self.factors = {}
+        self.paused_until = {}
+
+    @staticmethod
+    def get_key(api: Endpoint, token):
+        return api.name if api.is_public else (api.name, token)
+
+    def reserve(self, api: Endpoint, token=None):
+        key = RateLimiter.get_key(api, token)
+        with self.lock:
+            now = time.monotonic()
+            slots = self.slots[key]
+            slot = max(now, self.paused_until.get(key, now))
+            if len(slots) >= api.num_requests:
+                slot = max(slot, slots[-api.num_requests] + api.delay * self.factors.get(key, 1))
+            slots.append(slot)
+            while len(slots) > api.num_requests:
+                slots.popleft()
+            return slot - now
+
+    def get_waiting_time(self, api: Endpoint, token=None):
+        key = RateLimiter.get_key(api, token)
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.paused_until.get(key, now))
+            slots = self.slots.get(key, ())
+            if len(slots) >= api.num_requests:
+                slot = max(slot, slots[-api.num_requests] + api.delay * self.factors.get(key, 1))
+            return slot - now
+
+    def slow_down(self, api: Endpoint, token, pause):
+        key = RateLimiter.get_key(api, token)
+        with self.lock:
+            self.factors[key] = min(self.factors.get(key, 1) * 2, API_MAX_DELAY_FACTOR)
+            paused_until = time.monotonic() + pause
+            if paused_until > self.paused_until.get(key, 0):
+                self.paused_until[key] = paused_until
+
+    def throttle(self, api: Endpoint, token, r):
+        API_THROTTLED.inc(api.name)
+        pause = RateLimiter.get_retry_after(r)
+        self.slow_down(api, token, pause)
+        return pause
+
+    def speed_up(self, api: Endpoint, token=None):
+        key = RateLimiter.get_key(api, token)
+        with self.lock:
+            factor = self.factors.get(key)
+            if factor is not None:
+                factor *= API_DELAY_RECOVERY
+                if factor <= 1:
+                    del self.factors[key]
+                else:
+                    self.factors[key] = factor
+
+    @staticmethod
+    def get_retry_after(r):
+        value = r.headers.get('Retry-After')
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                pass
+            try:
+                return max(0.0, (parsedate_to_datetime(value) - datetime.now(tz=tz.tzutc())).total_seconds())
+            except Exception:
+                pass
+        return API_RETRY_AFTER
+
+
+class ResponseCache:
+    # LRU cache of successful GET responses shared by all mods. Entries are scoped by token,
+    # so a response is only reused for requests made with the same permissions.
+    def __init__(self, max_size=API_CACHE_SIZE):
+        self.lock = Lock()
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(api: Endpoint, url, token, kwargs):
+        scope = None if api.is_public else token
+        params = kwargs.get('params')
+        headers = kwargs.get('headers')
+        return api.name, url, scope, str(sorted(params.items())) if params else None, \
+            str(sorted(headers.items())) if headers else None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, r = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    API_CACHE.inc("hit")
+                    return r
+                del self.entries[key]
+            self.misses += 1
+            API_CACHE.inc("miss")
+            return None
+
+    def put(self, key, ttl, r):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, r)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        # Drops all cached responses about the user, e.g. after a mod action changed their notes or mod log
+        username = username.lower()
+        with self.lock:
+            keys = [key for key in self.entries if username in key[1].lower().split('/')]
+            for key in keys:
+                del self.entries[key]
+
+    def get_status(self):
+        with self.lock:
+            num_requests = self.hits + self.misses
+            ratio = f" ({self.hits / num_requests:.0%})" if num_requests else ""
+            return f"API cache: {len(self.entries):,} entries, {self.hits:,} hits{ratio}, {self.misses:,} misses, " \
+                   f"{Api.num_coalesced:,} coalesced"
+
+
+class Flight:
+    # An in-flight GET: identical requests made meanwhile wait for its response instead of sending their own
+    def __init__(self):
+        self.done = Event()
+        self.response = None
+        self.exception = None
+
+
+class StreamQueue:
+    # Lichess allows only one NDJSON stream at a time per token: streams of the same token are served
+    # one by one in FIFO order, streams of different tokens run concurrently.
+    def __init__(self):
+        self.condition = Condition()
+        self.active = {}
+        self.waiting = defaultdict(deque)
+
+    @contextmanager
+    def slot(self, token, owner, url):
+        ticket = (owner, url, time.monotonic())
+        with self.condition:
+            queue = self.waiting[token]
+            queue.append(ticket)
+            if token in self.active and VERBOSE >= 2:
+                _, active_url, _ = self.active[token]
+                log(f"NDJSON: {owner or 'litools'} is waiting for {active_url} ({len(queue)} in queue): {url}",
+                    to_print=True, to_save=False)
+            while token in self.active or queue[0] is not ticket:
+                self.condition.wait()
+            NDJSON_QUEUE_WAIT.observe(time.monotonic() - ticket[2])
+            queue.popleft()
+            if not queue:
+                del self.waiting[token]
+            self.active[token] = ticket
+        try:
+            yield
+        finally:
+            with self.condition:
+                del self.active[token]
+                self.condition.notify_all()
+
+    def get_status(self):
+        with self.condition:
+            now = time.monotonic()
+            lines = []
+            for token, (owner, url, t) in self.active.items():
+                lines.append(f"{owner or 'litools'}: streaming for {now - t:.0f}s {url}")
+                for owner_w, url_w, t_w in self.waiting.get(token, []):
+                    lines.append(f"{owner_w or 'litools'}: waiting for {now - t_w:.0f}s {url_w}")
+            return lines
 
 
 class Api:
-    ndjson_lock = Lock()
-    clients = {}
+    cache = ResponseCache()
+    streams = StreamQueue()
+    flights_lock = Lock()
+    flights = {}
+    num_coalesced = 0
+    clients = ClientPool(Client)
+    limiter = RateLimiter()
 
     def __init__(self):
-        self.api_times = defaultdict(list)
+        self.owner = ""
+        self.async_api: AsyncApi = None
+
+    def get_async_api(self):
+        if self.async_api is None:
+            self.async_api = AsyncApi()
+        return self.async_api
 
-    def wait(self, api: Endpoint):
-        wait_s = 0
-        if len(self.api_times[api.name]) >= api.num_requests:
-            now = datetime.now()
-            wait_s = api.delay - (now - self.api_times[api.name][-api.num_requests]).total_seconds()
+    def iter_many(self, requests):
+        # requests: list of (method, api, url, token, kwargs)
+        # Runs them concurrently within the same Endpoint rate rules and yields (index, response) as soon as
+        # each request is done; an exception is yielded in place of the response of a failed request.
+        async_api = self.get_async_api()
+        loop = EventLoop.get()
+        futures = {asyncio.run_coroutine_threadsafe(async_api.request(method, api, url, token, **kwargs), loop): i
+                   for i, (method, api, url, token, kwargs) in enumerate(requests)}
+        for future in as_completed(futures):
+            exception = future.exception()
+            yield futures[future], future.result() if exception is None else exception
+
+    def wait(self, api: Endpoint, token=None):
+        wait_s = self.limiter.reserve(api, token)
+        API_QUEUE_WAIT.observe(wait_s, api.name)
         if wait_s > 0:
             if VERBOSE >= 4:
                 print(f'Waiting for "{api.name}" for {wait_s:0.1f}s')
             time.sleep(wait_s)
-        self.finish(api)  # or after it's completed?
 
-    def finish(self, api: Endpoint):
-        self.api_times[api.name].append(datetime.now())
-        if len(self.api_times[api.name]) > api.num_requests:
-            self.api_times[api.name] = self.api_times[api.name][-api.num_requests:]
+    def get_waiting_time(self, api: Endpoint, token=None):
+        return self.limiter.get_waiting_time(api, token)
 
-    def get_waiting_time(self, api: Endpoint):
-        now = datetime.now()
-        if len(self.api_times[api.name]) >= api.num_requests:
-            return api.delay - (now - self.api_times[api.name][-api.num_requests]).total_seconds()
-        return 0
+    @staticmethod
+    def invalidate(username):
+        Api.cache.invalidate(username)
 
     def prepare(self, api: Endpoint, url, token, tag, **kwargs):
         if VERBOSE >= 3:
             print(f"request {datetime.now(tz=tz.tzutc()):%H:%M:%S.%f}: {tag} {url}")
-        self.wait(api)
+        self.wait(api, token)
         if token is None:
             headers = kwargs.pop('headers', None)
         else:
@@ -139,176 +490,294 @@ class Api:
             log(f"...{dt:.1f}s to {tag} {short_url}", True)
 
     @staticmethod
-    def get_client(key):
-        client = Api.clients.get(key)
-        if client:
-            return client
-        client = Client()
-        Api.clients[key] = client
-        return client
+    def observe(api: Endpoint, method, r, t0):
+        API_LATENCY.observe(time.monotonic() - t0, api.name, method)
+        API_RESPONSE_SIZE.observe(len(r.content), api.name)
+        API_RESPONSES.inc(api.name, str(r.status_code))
 
-    def get(self, api: Endpoint, url, token=None, **kwargs):
-        with api.lock:
-            headers = self.prepare(api, url, token, "GET", **kwargs)
-            kwargs.pop('headers', None)
-            client = Api.get_client(token)
-            for repeat in range(MAX_RETRIES):
-                try:
-                    client.check()
+    def request(self, method, api: Endpoint, url, token=None, **kwargs):
+        url = get_url(url)
+        if method != "GET":
+            return self.send(method, api, url, token, **kwargs)
+        key = ResponseCache.get_key(api, url, token, kwargs)
+        with Api.flights_lock:
+            if api.ttl:
+                r = Api.cache.get(key)
+                if r is not None:
+                    return r
+            flight = Api.flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = Flight()
+                Api.flights[key] = flight
+            else:
+                Api.num_coalesced += 1
+                API_CACHE.inc("coalesced")
+        if not is_leader:
+            if VERBOSE >= 4:
+                print(f"Waiting for the same request in flight: {url}")
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.response
+        try:
+            flight.response = self.send(method, api, url, token, **kwargs)
+            if api.ttl and flight.response.status_code == 200:
+                Api.cache.put(key, api.ttl, flight.response)
+            return flight.response
+        except Exception as exception:
+            flight.exception = exception
+            raise exception
+        finally:
+            with Api.flights_lock:
+                del Api.flights[key]
+            flight.done.set()
+
+    def send(self, method, api: Endpoint, url, token=None, **kwargs):
+        headers = self.prepare(api, url, token, method, **kwargs)
+        kwargs.pop('headers', None)
+        if method == "GET":
+            kwargs['follow_redirects'] = True
+        for repeat in range(MAX_RETRIES):
+            connection = None
+            try:
+                with self.clients.use(token) as (client, connection):
                     t1_utc = datetime.now(tz=tz.tzutc())
-                    r = client.httpx.get(url, follow_redirects=True, headers=headers, **kwargs)
-                    Api.check_delay("GET", url, t1_utc)
-                    client.request_counter += 1
-                    if r.status_code == 429:
-                        log(f"ERROR: Status 429: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f} GET: {url}")
-                        time.sleep(60)
-                    else:
-                        break
-                except httpx.ReadError:
-                    if repeat < MAX_RETRIES - 1:
-                        client.restart()
-                        continue
-                    raise Exception(f"Timeout: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f} GET: {url}")
-                except httpx.ProtocolError as exception:
-                    log_exception(exception, to_print=False)
-                    time.sleep(6)
+                    t0 = time.monotonic()
+                    r = connection.httpx.request(method, url, headers=headers, **kwargs)
+                Api.check_delay(method, url, t1_utc)
+                Api.observe(api, method, r, t0)
+                if r.status_code == 429:
+                    pause = self.limiter.throttle(api, token, r)
+                    log(f"ERROR: Status 429: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f} {method}: {url} "
+                        f"(retry after {pause:.0f}s)")
                     if repeat < MAX_RETRIES - 1:
-                        client.restart()
-                        continue
-                    raise exception
-                except Exception as exception:
-                    print(f"Error for {url}")
-                    print("Waiting 5s...")
-                    time.sleep(5)
-                    raise exception
-            return r
+                        API_RETRIES.inc(api.name, "429")
+                        self.wait(api, token)
+                else:
+                    self.limiter.speed_up(api, token)
+                    break
+            except httpx.ReadError:
+                if repeat < MAX_RETRIES - 1:
+                    API_RETRIES.inc(api.name, "ReadError")
+                    client.restart(connection)
+                    continue
+                API_ERRORS.inc(api.name, "ReadError")
+                raise Exception(f"Timeout: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f} {method}: {url}")
+            except httpx.ProtocolError as exception:
+                log_exception(exception, to_print=False)
+                self.limiter.slow_down(api, token, API_ERROR_PAUSE)
+                if repeat < MAX_RETRIES - 1:
+                    API_RETRIES.inc(api.name, type(exception).__name__)
+                    client.restart(connection)
+                    self.wait(api, token)
+                    continue
+                API_ERRORS.inc(api.name, type(exception).__name__)
+                raise exception
+            except Exception as exception:
+                print(f"Error for {url}")
+                API_ERRORS.inc(api.name, type(exception).__name__)
+                self.limiter.slow_down(api, token, API_ERROR_PAUSE)
+                raise exception
+        return r
+
+    def get(self, api: Endpoint, url, token=None, **kwargs):
+        return self.request("GET", api, url, token, **kwargs)
 
     def post(self, api: Endpoint, url, token=None, **kwargs):
-        with api.lock:
-            headers = self.prepare(api, url, token, "POST", **kwargs)
-            kwargs.pop('headers', None)
-            client = Api.get_client(token)
-            for repeat in range(MAX_RETRIES):
-                try:
-                    client.check()
-                    t1_utc = datetime.now(tz=tz.tzutc())
-                    r = client.httpx.post(url, headers=headers, **kwargs)
-                    Api.check_delay("POST", url, t1_utc)
-                    client.request_counter += 1
-                    if r.status_code == 429:
-                        log(f"ERROR: Status 429: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f} POST: {url}")
-                        time.sleep(60)
-                    else:
-                        break
-                except httpx.ReadError:
-                    if repeat < MAX_RETRIES - 1:
-                        client.restart()
-                        continue
-                    raise Exception(f"Timeout: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f} POST: {url}")
-                except httpx.ProtocolError as exception:
-                    log_exception(exception, to_print=False)
-                    time.sleep(6)
-                    if repeat < MAX_RETRIES - 1:
-                        client.restart()
-                        continue
-                    raise exception
-                except Exception as exception:
-                    print(f"Error for {url}")
-                    print("Waiting 5s...")
-                    time.sleep(5)
-                    raise exception
-            return r
+        return self.request("POST", api, url, token, **kwargs)
 
     def delete(self, api: Endpoint, url, token=None, **kwargs):
-        with api.lock:
-            headers = self.prepare(api, url, token, "DELETE", **kwargs)
-            kwargs.pop('headers', None)
-            client = Api.get_client(token)
+        return self.request("DELETE", api, url, token, **kwargs)
+
+    def get_ndjson(self, api, url, token, params=None, Accept="application/x-ndjson"):
+        return list(self.iter_ndjson(api, url, token, params, Accept))
+
+    def iter_ndjson(self, api, url, token, params=None, Accept="application/x-ndjson"):
+        # Yields the parsed objects one by one as the lines arrive, so only one object is kept in memory.
+        # Closing the generator early (e.g. `break` in the caller's loop) terminates the download.
+        url = get_url(url)
+        if VERBOSE >= 3:
+            print(f"request {datetime.now(tz=tz.tzutc()):%H:%M:%S.%f}: {url}")
+        self.wait(api, token)
+        headers = {'Accept': Accept}
+        if token:
+            headers['Authorization'] = f"Bearer {token}"
+        status_code = None
+        with Api.streams.slot(token, self.owner, url):
             for repeat in range(MAX_RETRIES):
+                is_streaming = False
+                connection = None
                 try:
-                    client.check()
                     t1_utc = datetime.now(tz=tz.tzutc())
-                    r = client.httpx.delete(url, headers=headers, **kwargs)
-                    Api.check_delay("DELETE", url, t1_utc)
-                    client.request_counter += 1
-                    if r.status_code == 429:
-                        log(f"ERROR: Status 429: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f} DELETE: {url}")
-                        time.sleep(60)
-                    else:
-                        break
+                    t0 = time.monotonic()
+                    with self.clients.use(token) as (client, connection):
+                        with connection.httpx.stream("GET", url, follow_redirects=True, headers=headers,
+                                                     params=params) as r:
+                            if api.name != ApiType.ApiGamesUser.name:
+                                Api.check_delay("GET", url, t1_utc)
+                            API_LATENCY.observe(time.monotonic() - t0, api.name, "GET")
+                            API_RESPONSES.inc(api.name, str(r.status_code))
+                            status_code = r.status_code
+                            if status_code == 429:
+                                pause = self.limiter.throttle(api, token, r)
+                                if repeat < MAX_RETRIES - 1:
+                                    if VERBOSE >= 3:
+                                        log(f"ERROR: Status 429: waiting {pause:.0f}s... "
+                                            f"{datetime.now():%H:%M:%S.%f} {url}")
+                                    API_RETRIES.inc(api.name, "429")
+                                    self.wait(api, token)
+                                    continue
+                            if status_code != 200:
+                                break
+                            self.limiter.speed_up(api, token)
+                            is_streaming = True
+                            for line in r.iter_lines():
+                                if line:
+                                    yield json.loads(line)
+                            API_RESPONSE_SIZE.observe(r.num_bytes_downloaded, api.name)
+                            break
                 except httpx.ReadError:
-                    if repeat < MAX_RETRIES - 1:
-                        client.restart()
+                    if repeat < MAX_RETRIES - 1 and not is_streaming:
+                        API_RETRIES.inc(api.name, "ReadError")
+                        client.restart(connection)
                         continue
-                    raise Exception(f"Timeout: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f} DELETE: {url}")
+                    API_ERRORS.inc(api.name, "ReadError")
+                    raise Exception(f"Timeout: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f}: {url}")
                 except httpx.ProtocolError as exception:
                     log_exception(exception, to_print=False)
-                    time.sleep(6)
-                    if repeat < MAX_RETRIES - 1:
-                        client.restart()
+                    self.limiter.slow_down(api, token, API_ERROR_PAUSE)
+                    if repeat < MAX_RETRIES - 1 and not is_streaming:
+                        API_RETRIES.inc(api.name, type(exception).__name__)
+                        client.restart(connection)
+                        self.wait(api, token)
                         continue
+                    API_ERRORS.inc(api.name, type(exception).__name__)
                     raise exception
                 except Exception as exception:
                     print(f"Error for {url}")
-                    print("Waiting 5s...")
-                    time.sleep(5)
+                    API_ERRORS.inc(api.name, type(exception).__name__)
+                    self.limiter.slow_down(api, token, API_ERROR_PAUSE)
                     raise exception
-            return r
-
-    def get_ndjson(self, api, url, token, params=None, Accept="application/x-ndjson"):
-        if VERBOSE >= 3:
-            print(f"request {datetime.now(tz=tz.tzutc()):%H:%M:%S.%f}: {url}")
-        with api.lock:
-            self.wait(api)
-            headers = {'Accept': Accept,
-                       'Authorization': f"Bearer {token}"}
-            with Api.ndjson_lock:
-                client = Api.get_client(token)
-                for repeat in range(MAX_RETRIES):
-                    try:
-                        client.check()
-                        t1_utc = datetime.now(tz=tz.tzutc())
-                        r = client.httpx.get(url, follow_redirects=True, headers=headers, params=params)
-                        if api.name != ApiType.ApiGamesUser.name:
-                            Api.check_delay("GET", url, t1_utc)
-                        client.request_counter += 1
-                        if r.status_code == 429:
-                            if VERBOSE >= 3:
-                                log(f"ERROR: Status 429: waiting 60s... {datetime.now():%H:%M:%S.%f} {url}")
-                            time.sleep(60)
-                        else:
-                            break
-                    except httpx.ReadError:
-                        if repeat < MAX_RETRIES - 1:
-                            client.restart()
-                            continue
-                        raise Exception(f"Timeout: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f}: {url}")
-                    except httpx.ProtocolError as exception:
-                        log_exception(exception, to_print=False)
-                        if repeat < MAX_RETRIES - 1:
-                            client.restart()
-                            continue
-                        time.sleep(6)
-                        raise exception
-                    except Exception as exception:
-                        print(f"Error for {url}")
-                        print("Waiting 5s...")
-                        time.sleep(5)
-                        raise exception
         if VERBOSE >= 4:
             print(f"finish {datetime.now(tz=tz.tzutc()):%H:%M:%S.%f}: {url}")
-        if r.status_code != 200:
+        if status_code != 200:
             try:
                 i1 = url.find(".org/")
                 i2 = url.rfind("/")
                 endpoint = url[i1 + 4:i2 + 1]
             except:
                 endpoint = url
-            raise Exception(f"{endpoint}: Status code = {r.status_code}")
-        content = r.content.decode("utf-8")
-        lines = content.split("\n")[:-1]
-        data = [json.loads(line) for line in lines]
-        return data
+            raise Exception(f"{endpoint}: Status code = {status_code}")
+
+
+class AsyncApi:
+    clients = ClientPool(AsyncClient)
+    flights = {}
+    limiter = Api.limiter
+
+    async def wait(self, api: Endpoint, token=None):
+        wait_s = self.limiter.reserve(api, token)
+        API_QUEUE_WAIT.observe(wait_s, api.name)
+        if wait_s > 0:
+            if VERBOSE >= 4:
+                print(f'Waiting for "{api.name}" for {wait_s:0.1f}s')
+            await asyncio.sleep(wait_s)
+
+    async def request(self, method, api: Endpoint, url, token=None, **kwargs):
+        url = get_url(url)
+        if method != "GET":
+            return await self.send(method, api, url, token, **kwargs)
+        # All coroutines run on the same event loop, so the flights don't need a lock
+        key = ResponseCache.get_key(api, url, token, kwargs)
+        if api.ttl:
+            r = Api.cache.get(key)
+            if r is not None:
+                return r
+        flight = AsyncApi.flights.get(key)
+        if flight is not None:
+            Api.num_coalesced += 1
+            API_CACHE.inc("coalesced")
+            return await asyncio.shield(flight)
+        flight = asyncio.get_running_loop().create_future()
+        AsyncApi.flights[key] = flight
+        try:
+            r = await self.send(method, api, url, token, **kwargs)
+            if api.ttl and r.status_code == 200:
+                Api.cache.put(key, api.ttl, r)
+            flight.set_result(r)
+            return r
+        except Exception as exception:
+            flight.set_exception(exception)
+            flight.exception()  # mark as retrieved if nobody else was waiting
+            raise exception
+        finally:
+            del AsyncApi.flights[key]
+            if not flight.done():
+                flight.cancel()
+
+    async def send(self, method, api: Endpoint, url, token=None, **kwargs):
+        if VERBOSE >= 3:
+            print(f"async request {datetime.now(tz=tz.tzutc()):%H:%M:%S.%f}: {method} {url}")
+        await self.wait(api, token)
+        if token is None:
+            headers = kwargs.pop('headers', None)
+        else:
+            headers = kwargs.pop('headers', {}).copy()
+            headers['Authorization'] = f"Bearer {token}"
+        if method == "GET":
+            kwargs['follow_redirects'] = True
+        for repeat in range(MAX_RETRIES):
+            connection = None
+            try:
+                with self.clients.use(token) as (client, connection):
+                    t1_utc = datetime.now(tz=tz.tzutc())
+                    t0 = time.monotonic()
+                    r = await connection.httpx.request(method, url, headers=headers, **kwargs)
+                Api.check_delay(method, url, t1_utc)
+                Api.observe(api, method, r, t0)
+                if r.status_code == 429:
+                    pause = self.limiter.throttle(api, token, r)
+                    log(f"ERROR: Status 429: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f} {method}: {url} "
+                        f"(retry after {pause:.0f}s)")
+                    if repeat < MAX_RETRIES - 1:
+                        API_RETRIES.inc(api.name, "429")
+                        await self.wait(api, token)
+                else:
+                    self.limiter.speed_up(api, token)
+                    break
+            except httpx.ReadError:
+                if repeat < MAX_RETRIES - 1:
+                    API_RETRIES.inc(api.name, "ReadError")
+                    client.restart(connection)
+                    continue
+                API_ERRORS.inc(api.name, "ReadError")
+                raise Exception(f"Timeout: {datetime.now(tz=tz.tzutc()):%Y-%m-%d %H:%M:%S.%f} {method}: {url}")
+            except httpx.ProtocolError as exception:
+                log_exception(exception, to_print=False)
+                self.limiter.slow_down(api, token, API_ERROR_PAUSE)
+                if repeat < MAX_RETRIES - 1:
+                    API_RETRIES.inc(api.name, type(exception).__name__)
+                    client.restart(connection)
+                    await self.wait(api, token)
+                    continue
+                API_ERRORS.inc(api.name, type(exception).__name__)
+                raise exception
+            except Exception as exception:
+                print(f"Error for {url}")
+                API_ERRORS.inc(api.name, type(exception).__name__)
+                self.limiter.slow_down(api, token, API_ERROR_PAUSE)
+                raise exception
+        return r
+
+    async def get(self, api: Endpoint, url, token=None, **kwargs):
+        return await self.request("GET", api, url, token, **kwargs)
+
+    async def post(self, api: Endpoint, url, token=None, **kwargs):
+        return await self.request("POST", api, url, token, **kwargs)
+
+    async def delete(self, api: Endpoint, url, token=None, **kwargs):
+        return await self.request("DELETE", api, url, token, **kwargs)
 
 
 def log(text, to_print=False, to_save=True, verbose=1):
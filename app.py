@@ -11,19 +11,24 @@ import requests
 from datetime import datetime, timedelta
 from dateutil import tz
 import math
+import hmac
+import time
 import re
 from peewee import DoesNotExist
 from boost import get_boost_data, send_boost_note, send_mod_action
 from leaderboard import update_leaderboard
 from chat import ChatAnalysis
+from chat_message import Message
 from alt import Alts
 from footprints import analyze_footprints, cancel_footprints, get_footprints, variants1, variants2
 from search import search_users
 from mod import Mod, ModInfo, View
-from elements import get_client_id, get_host, get_port, get_num_threads, get_embed_lichess
+from elements import get_client_id, get_host, get_port, get_num_threads, get_embed_lichess, get_metrics_token
 from elements import get_token, get_room_token, get_uri, delta_s, close_account
 from elements import log, log_exception, log_read
 from database import Mods, Authentication
+from api import get_url
+from metrics import export_metrics, CHAT_LOOP_ITERATIONS, CHAT_LOOP_DURATION
 from consts import *
 
 
@@ -180,23 +185,13 @@ def create_chat():
     return resp
 
 
-@app.route('/chat/update/<state>', methods=['POST'])
-def get_chat_update(state):
-    try:
-        get_mod(request.cookies)  # can be omitted
-    except:
-        return Response(status=400)
-    resp = make_response(chat.get_tournaments_data(state))
-    return resp
-
-
-@app.route('/chat/process/<state>', methods=['POST'])
-def get_chat_process(state):
+@app.route('/chat/poll/<version>', methods=['POST'])
+def get_chat_poll(version):
     try:
         mod = get_mod(request.cookies)
     except:
         return Response(status=400)
-    data = chat.get_all_data(mod, state)
+    data = chat.get_changed_data(mod, version)
     return make_response(data)
 
 
@@ -547,13 +542,19 @@ def chat_loop():
     global chat
     last_update_count = 0
     while True:
+        dt = 0
         if chat.wait_refresh_tournaments():
+            t0 = time.monotonic()
             chat.update_tournaments(non_mod)
+            dt = time.monotonic() - t0
         chat.wait_refresh_chats()
+        t0 = time.monotonic()
         chat.update_chats(room_mod, auto_mod)
         if chat.update_count >= last_update_count + 100:
             last_update_count = chat.update_count
             chat.clear_messages_database()
+        CHAT_LOOP_DURATION.observe(dt + time.monotonic() - t0)
+        CHAT_LOOP_ITERATIONS.inc()
 
 
 def encode_base64(b):
@@ -672,12 +673,27 @@ def log_data(lines, page):
         mod = get_mod(request.cookies, update_theme=True, update_seenAt=True)
         view = mod.view if mod else View()
         reverse = False if request.args.get('reverse', "true").lower() in ["false", "0"] else True
-        text = log_read(int(lines), int(page), reverse) if mod.is_admin else f"Version: {LITOOLS_VERSION[1:]}"
+        text = log_read(int(lines), int(page), reverse, [Message.eval_cache.get_status()]) if mod.is_admin \
+            else f"Version: {LITOOLS_VERSION[1:]}"
         return make_response(render_template('/log.html', view=view, icon="", log=text))
     except:
         return make_response(redirect('/login'))
 
 
+@app.route("/metrics", methods=['GET'])
+def metrics_data():
+    metrics_token = get_metrics_token()
+    authorization = request.headers.get('Authorization', "")
+    if not (metrics_token and hmac.compare_digest(authorization, f"Bearer {metrics_token}")):
+        try:
+            mod = get_mod(request.cookies)
+            if not mod.is_admin:
+                return Response(status=403)
+        except:
+            return Response(status=401)
+    return Response(export_metrics(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/logout", methods=['GET'])
 def logout():
     try:
@@ -716,7 +732,7 @@ def login():
                   'state': state}
         session['code_verifier'] = verifier
         session['state'] = state
-        resp = make_response(redirect(f'https://lichess.org/oauth?{urlencode(params, quote_via=quote_plus)}'))
+        resp = make_response(redirect(get_url(f'https://lichess.org/oauth?{urlencode(params, quote_via=quote_plus)}')))
     except Exception as exception:
         log_exception(exception)
         mod_none: Mod = None
@@ -770,7 +786,7 @@ def oauth2_callback():
                 'code_verifier': verifier,
                 'redirect_uri': f'{get_uri()}{AUTH_ENDPOINT}',
                 'client_id': get_client_id()}
-        r = requests.post(f"https://lichess.org/api/token", headers=headers, json=data)
+        r = requests.post(get_url("https://lichess.org/api/token"), headers=headers, json=data)
         if r.status_code != 200:
             try:
                 error_info = get_auth_error(r.json(), "Access Token")
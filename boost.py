@@ -290,7 +290,7 @@ class UserTournament:
                     self.score = player['score']
                     break
             url = f"https://lichess.org/api/tournament/{self.tournament_id}/results?nb={MAX_NUM_TOURNEY_PLAYERS}"
-            arena_res = mod.api.get_ndjson(ApiType.ApiTournamentResults, url, mod.token)
+            arena_res = mod.api.iter_ndjson(ApiType.ApiTournamentResults, url, mod.token)
             for player in arena_res:
                 if player['username'].lower() == self.user_id:
                     self.place = player['rank']
@@ -1,19 +1,21 @@
 from datetime import datetime, timedelta
 from dateutil import tz
 import time
-from threading import Lock
+from threading import Lock, Thread, Condition
 import re
 import sys
+import heapq
 from collections import defaultdict
 from typing import DefaultDict, Dict
 import html
-from api import ApiType
-from elements import Reason, TournType, delta_s, log, log_exception, get_notes, add_note
+from api import ApiType, Api
+from elements import Reason, TournType, delta_s, log, log_exception, get_notes, add_note, get_num_threads
 from elements import load_mod_log, load_timeout_log, get_mod_log, get_highlight_style, add_timeout_msg
 from elements import ModActionType, ModAction, UserData
 from chat_message import Message
 from chat_tournament import Tournament
-from database import Messages, db
+from database import Messages, text_contains, delete_old_messages
+from metrics import CHAT_UPDATE_DURATION
 from consts import *
 
 
@@ -56,6 +58,11 @@ class ChatAnalysis:
         self.i_update_frequency = 1  # len(API_CHAT_REFRESH_PERIOD) - 1
         self.reset_multi_messages = set()
         self.update_count = 0
+        self.chat_schedule = []  # heap of (update_count to refresh at, sequence number, tournament ID)
+        self.chat_schedule_seq = {}  # tournament ID: sequence number of its only valid entry in chat_schedule
+        self.num_scheduled = 0
+        self.schedule_lock = Lock()
+        self.clear_db_thread: Thread = None
         self.tournament_groups = {"monitored": True, "started": True, "created": True, "finished": True}
         self.msg_lock = Lock()
         self.tournaments_lock = Lock()
@@ -68,6 +75,11 @@ class ChatAnalysis:
         self.state_users = 0
         self.cache_tournaments = {'state_tournaments': 0}
         self.cache_reports = {'state_reports': 0}
+        self.sections = {}  # (mod ID or "", key): (version, HTML) of the sections of the /chat page
+        self.sections_version = 0
+        self.sections_cond = Condition()
+        self.num_polls_waiting = 0
+        self.max_polls_waiting = get_num_threads() - 1  # keep a thread for the other requests
         # Mod data
         self.users: DefaultDict[str, Dict[UserData]] = defaultdict(dict)
         self.selected_msg_id: DefaultDict[str, int] = defaultdict(int)
@@ -127,6 +139,10 @@ class ChatAnalysis:
                         del self.tournaments[tourn_id]
                 for tourn_id, tourn in active_tournaments.items():
                     self.tournaments[tourn_id] = tourn
+                    if tourn.is_ongoing(now_utc):
+                        self.schedule_chat(tourn_id)
+                    else:  # spread the first refreshes
+                        self.schedule_chat(tourn_id, 1 + sum(ord(ch) for ch in tourn_id) % tourn.update_period(now_utc))
             self.state_tournaments += 1
             self.get_tournaments()
         except Exception as exception:
@@ -141,22 +157,15 @@ class ChatAnalysis:
             return
         now_utc = datetime.now(tz=tz.tzutc())
         try:
-            for tourn_id in list(self.tournaments.keys()):
-                tourn = self.tournaments[tourn_id]
-                if tourn.t_type == TournType.Swiss and not CHAT_UPDATE_SWISS:
-                    continue
-                if not tourn.is_just_added:
-                    if not tourn.is_enabled:
-                        continue
-                    is_ongoing = tourn.is_ongoing(now_utc)
-                    if self.update_count == 0 and not is_ongoing:
-                        continue
-                    if not is_ongoing:
-                        hash_num = sum(ord(ch) for ch in tourn_id)
-                        update_period = tourn.update_period(now_utc)
-                        if self.update_count % update_period != hash_num % update_period:
-                            continue
-                self.update_chat(tourn_id, room_mod, auto_mod, now_utc)
+            tourn_ids = self.pop_scheduled_chats(now_utc)
+            t0 = time.monotonic()
+            analysis_time = 0
+            for tourn_id, new_messages, deleted_messages in self.download_chats(tourn_ids, room_mod, now_utc):
+                t1 = time.monotonic()
+                self.process_chat(tourn_id, new_messages, deleted_messages, auto_mod, now_utc)
+                analysis_time += time.monotonic() - t1
+            CHAT_UPDATE_DURATION.observe(time.monotonic() - t0 - analysis_time, "download")
+            CHAT_UPDATE_DURATION.observe(analysis_time, "analysis")
         except Exception as exception:
             log_exception(exception)
             self.add_error(f"ERROR at {now_utc:%Y-%m-%d %H:%M} UTC: {exception}", True, 2)
@@ -167,6 +176,49 @@ class ChatAnalysis:
         self.prepare_reports()
         self.get_tournaments()
 
+    def schedule_chat(self, tourn_id, period=0):
+        # Replaces the previous entry of the tournament if any: it's skipped when popped from the heap
+        with self.schedule_lock:
+            self.num_scheduled += 1
+            self.chat_schedule_seq[tourn_id] = self.num_scheduled
+            heapq.heappush(self.chat_schedule, (self.update_count + period, self.num_scheduled, tourn_id))
+
+    def pop_scheduled_chats(self, now_utc):
+        # Returns the tournaments to refresh now and schedules their next refreshes
+        refresh_period = API_CHAT_REFRESH_PERIOD[self.i_update_frequency]
+        tourn_ids = []
+        with self.schedule_lock:
+            while self.chat_schedule and self.chat_schedule[0][0] <= self.update_count:
+                _, seq, tourn_id = heapq.heappop(self.chat_schedule)
+                if self.chat_schedule_seq.get(tourn_id) != seq:
+                    continue
+                tourn = self.tournaments.get(tourn_id)
+                if tourn is None or not tourn.is_enabled or (tourn.t_type == TournType.Swiss and not CHAT_UPDATE_SWISS):
+                    del self.chat_schedule_seq[tourn_id]  # scheduled again when added or enabled
+                    continue
+                self.num_scheduled += 1
+                self.chat_schedule_seq[tourn_id] = self.num_scheduled
+                period = tourn.next_update_period(now_utc, refresh_period)
+                heapq.heappush(self.chat_schedule, (self.update_count + period, self.num_scheduled, tourn_id))
+                tourn_ids.append(tourn_id)
+        return tourn_ids
+
+    def download_chats(self, tourn_ids, room_mod, now_utc):
+        # Downloads the chats concurrently within the rate limits of the endpoints and yields
+        # (tournament ID, new messages, deleted messages) as soon as each chat is downloaded
+        downloads = []
+        for tourn_id in tourn_ids:
+            tourn = self.tournaments[tourn_id]
+            tourn.is_just_added = False
+            new_messages, request = tourn.prepare_download(now_utc, room_mod)
+            if request is None:
+                yield tourn_id, new_messages, []
+            else:
+                downloads.append((tourn_id, tourn, new_messages, request))
+        for i, r in room_mod.api.iter_many([request for _, _, _, request in downloads]):
+            tourn_id, tourn, new_messages, request = downloads[i]
+            yield (tourn_id, *tourn.process_download(request, r, self.msg_lock, now_utc, new_messages))
+
     def update_chat(self, tourn_id, room_mod, auto_mod=None, now_utc=None):
         if now_utc is None:
             now_utc = datetime.now(tz=tz.tzutc())
@@ -174,6 +226,12 @@ class ChatAnalysis:
         if tourn.is_just_added:
             tourn.is_just_added = False
         new_messages, deleted_messages = tourn.download(self.msg_lock, now_utc, room_mod)
+        self.process_chat(tourn_id, new_messages, deleted_messages, auto_mod, now_utc)
+
+    def process_chat(self, tourn_id, new_messages, deleted_messages, auto_mod, now_utc):
+        tourn = self.tournaments.get(tourn_id)
+        if tourn is None:
+            return  # removed while its chat was being downloaded
         with self.msg_lock:
             if not new_messages and tourn.is_error_404_too_long(now_utc) and not tourn.has_sus_messages():
                 del self.tournaments[tourn_id]
@@ -203,7 +261,7 @@ class ChatAnalysis:
         try:
             msg = self.all_messages.get(int(msg_id[1:]))
             if msg is not None:
-                msg.is_reset = True
+                msg.set_reset()
                 if LOG_RESET_MSGS and msg.score > 20:
                     reason_tag = Reason.to_tag(msg.best_reason())
                     chan = "tournament" if msg.tournament.t_type == TournType.Arena \
@@ -248,6 +306,7 @@ class ChatAnalysis:
             return True
         # Assuming that actions are sorted
         last_action_time = user.actions[0].date if user.actions else None
+        mod.api.invalidate(name)
         self.update_selected_user(mod)
         updated_user = self.users[mod.id].get(name)
         if not updated_user:
@@ -278,6 +337,7 @@ class ChatAnalysis:
     @staticmethod
     def is_modlog_ok_for_timeout(msg, mod, check_perms=False):
         now_utc = datetime.now(tz=tz.tzutc())
+        mod.api.invalidate(msg.username)
         mod_log_data = load_mod_log(msg.username, mod) if mod.is_mod() else load_timeout_log(msg.username, mod)
         if mod_log_data is None:
             mod.last_mod_log_error = now_utc
@@ -342,6 +402,7 @@ class ChatAnalysis:
             if len(msg.text) > MAX_LEN_TEXT:
                 text = f'{text}{msg.text[MAX_LEN_TEXT-1:]}'
             if 200 <= r.status_code <= 299:
+                Api.invalidate(msg.username)
                 log(f"{timeout_tag}{reason_tag.upper()} @{msg.username} score={msg.score} "
                     f"{chan.upper()}={msg.tournament.id}: {text}", True, True, 2)
                 start_time = msg.time - timedelta(minutes=TIMEOUT_RANGE[0])
@@ -349,11 +410,11 @@ class ChatAnalysis:
                 for m in self.all_messages.values():
                     if m.username == msg.username and start_time < m.time < end_time:
                         m.set_timed_out()
-                        m.is_reset = False
+                        m.set_reset(False)
                 for m in msg.tournament.messages:
                     if m.username == msg.username:
                         m.set_timed_out()
-                        m.is_reset = False
+                        m.set_reset(False)
                 self.update_selected_user(mod)
                 self.recommended_timeouts.pop(msg.id, None)
             else:
@@ -421,6 +482,7 @@ class ChatAnalysis:
         r = mod.api.post(ApiType.ModWarn, url, token=mod.token)
         if r.status_code == 200:
             log(f"WARNING @{username}: {subject}", True, True, 2)
+            mod.api.invalidate(username)
             self.update_selected_user(mod)
         else:
             self.add_error(f"ERROR: Warn (status: {r.status_code}):<br>@{username}: <u>Subject</u>: {subject}", False)
@@ -433,6 +495,7 @@ class ChatAnalysis:
         r = mod.api.post(ApiType.ModKid, url, token=mod.token)
         if r.status_code == 200:
             log(f"ACTION @{username}: kidMode", True, True, 2)
+            mod.api.invalidate(username)
             if to_update:
                 self.update_selected_user(mod)
                 self.state_reports += 1
@@ -449,6 +512,7 @@ class ChatAnalysis:
         r = mod.api.post(ApiType.ModTroll, url, token=mod.token)
         if r.status_code == 200:
             log(f"SB @{username}", True, True, 2)
+            mod.api.invalidate(username)
             self.update_selected_user(mod)
         else:
             self.add_error(f"ERROR: SB (status: {r.status_code}):<br>@{username}", False)
@@ -760,6 +824,7 @@ class ChatAnalysis:
                 data.update({'selected-user': "", 'mod-notes': "", 'mod-log': "", 'user-info': "", 'user-profile': ""})
             data['state_reports'] = self.state_reports + self.state_users + self.state_selected_msg[mod.id]
             self.cache_selected_data[mod.id] = data
+            self.update_sections(data, mod.id)
             return data
 
         def make_selected(msg_selected, to_highlight=False):
@@ -955,6 +1020,7 @@ class ChatAnalysis:
                         self.tournaments[tourn_id] = Tournament(data, TournType.Study, link=page, is_monitored=True)
                 self.tournaments[tourn_id].is_just_added = True
                 self.update_chat(tourn_id, room_mod, auto_mod)
+                self.schedule_chat(tourn_id, 1)
                 self.state_tournaments += 1
                 self.state_reports += 1
         return self.get_tournaments()
@@ -980,16 +1046,47 @@ class ChatAnalysis:
         active_tournaments.sort(key=lambda tourn: tourn.priority_time(now_utc), reverse=True)
         return active_tournaments
 
-    def get_all_data(self, mod, state):
-        if state is not None:
-            try:
-                state = int(state)
-            except:
-                state = -1
-            state_all = self.state_reports + self.state_users + self.state_selected_msg[mod.id]
-            if state == state_all:
-                return {'state_reports': state}
-        return self.get_all(mod)
+    def update_sections(self, data, mod_id=""):
+        with self.sections_cond:
+            for key, value in data.items():
+                if not key.startswith("state_"):
+                    section = self.sections.get((mod_id, key))
+                    if section is None or section[1] != value:
+                        self.sections_version += 1
+                        self.sections[(mod_id, key)] = self.sections_version, value
+            self.sections_cond.notify_all()
+
+    def get_changed_data(self, mod, version):
+        # Returns the sections changed after the version, waits for changes up to CHAT_POLL_TIMEOUT
+        try:
+            version = int(version)
+        except:
+            version = 0
+        end_time = time.monotonic() + CHAT_POLL_TIMEOUT
+        is_waiting = False
+        try:
+            while True:
+                self.prepare_reports()
+                with self.reports_lock:
+                    self.update_selected_data(mod)
+                with self.sections_cond:
+                    if version > self.sections_version:
+                        version = 0  # restarted
+                    data = {key: value for (mod_id, key), (v, value) in self.sections.items()
+                            if v > version and mod_id in ("", mod.id)}
+                    wait_s = end_time - time.monotonic()
+                    if not data and wait_s > 0 and not is_waiting \
+                            and self.num_polls_waiting < self.max_polls_waiting:
+                        self.num_polls_waiting += 1
+                        is_waiting = True
+                    if data or not is_waiting or wait_s <= 0:
+                        data['version'] = self.sections_version
+                        return data
+                    self.sections_cond.wait(wait_s)
+        finally:
+            if is_waiting:
+                with self.sections_cond:
+                    self.num_polls_waiting -= 1
 
     def get_all(self, mod):
         self.prepare_reports()
@@ -1011,14 +1108,15 @@ class ChatAnalysis:
             where &= Messages.time <= date_end
         if username:
             where &= Messages.username.collate('NOCASE') == username
-        if text:
-            where &= Messages.text.contains(text).collate('NOCASE')
         if tournId:
             where &= Messages.tournament.collate('NOCASE') == tournId
         try:
-            limit = int(num_msgs)
+            limit = max(0, int(num_msgs))  # a negative LIMIT is no limit in SQLite
         except:
             limit = 100
+        if text:
+            # the indexes on the user names and the tournament IDs are more selective than the full-text index
+            where &= text_contains(text, limit) if not username and not tournId else Messages.text.contains(text)
         msgs = [[f'{msg.time:%Y-%m-%d %H:%M}', msg.tournament, msg.username, html.escape(msg.text)]
                 for msg in Messages.select().where(where).order_by(*order_by).limit(limit).execute()]
         return msgs
@@ -1047,16 +1145,7 @@ class ChatAnalysis:
                 str_time = f"{now_utc:%H:%M} UTC"
                 self.cache_reports = {'reports': info, 'multiline-reports': info_frequent,
                                       'time': str_time, 'state_reports': self.state_reports}
-
-    def get_tournaments_data(self, state):
-        try:
-            state = int(state)
-        except:
-            state = -1
-        with self.tournaments_lock:
-            if state == self.cache_tournaments['state_tournaments']:
-                return {'state_tournaments': state}
-            return self.cache_tournaments.copy()
+                self.update_sections(self.cache_reports)
 
     def get_tournaments(self, active_tournaments=None):
         with self.tournaments_lock:
@@ -1129,6 +1218,7 @@ class ChatAnalysis:
             for state, t in self.cache_tournaments.items():
                 self.cache_tournaments[state] = "".join(t)
             self.cache_tournaments['state_tournaments'] = self.state_tournaments + self.state_reports
+            self.update_sections(self.cache_tournaments)
             return self.cache_tournaments
 
     def send_note(self, note, username, mod):
@@ -1157,10 +1247,12 @@ class ChatAnalysis:
         return {'selected-user': username, 'mod-notes': "", 'user-profile': "", 'user-info': ""}
 
     def clear_messages_database(self):
+        if self.clear_db_thread is not None and self.clear_db_thread.is_alive():
+            return
         old_dt = datetime.now(tz=tz.tzutc()).replace(tzinfo=None) - timedelta(days=CHAT_MSGS_LIFETIME)
-        with db.atomic():
-            with self.msg_lock:
-                Messages.delete().where(Messages.time < old_dt).execute()
+        self.clear_db_thread = Thread(name="clear_messages_database", target=delete_old_messages, args=(old_dt,),
+                                      daemon=True)
+        self.clear_db_thread.start()
 
 
 def get_current_tournaments(non_mod):
@@ -1168,8 +1260,7 @@ def get_current_tournaments(non_mod):
     arenas = []
     for teamId in tournament_teams:
         url = f"https://lichess.org/api/team/{teamId}/arena"
-        data = non_mod.api.get_ndjson(ApiType.ApiTeamArena, url, non_mod.token)
-        arenas.extend(data)
+        arenas.extend(non_mod.api.iter_ndjson(ApiType.ApiTeamArena, url, non_mod.token))
     # Arena
     url = "https://lichess.org/api/tournament"
     r = non_mod.api.get(ApiType.ApiTournament, url, token=None)
@@ -1190,8 +1281,7 @@ def get_current_tournaments(non_mod):
     swiss_ids = set()
     for teamId in tournament_teams:
         url = f"https://lichess.org/api/team/{teamId}/swiss"
-        swiss_data = non_mod.api.get_ndjson(ApiType.ApiTeamSwiss, url, non_mod.token, params={'max': 300})
-        for swiss in swiss_data:
+        for swiss in non_mod.api.iter_ndjson(ApiType.ApiTeamSwiss, url, non_mod.token, params={'max': 300}):
             try:
                 if swiss['id'] not in swiss_ids:
                     swiss_ids.add(swiss['id'])
@@ -1202,8 +1292,7 @@ def get_current_tournaments(non_mod):
                 log_exception(exception)
     # Broadcast
     url = f"https://lichess.org/api/broadcast?nb={NUM_RECENT_BROADCASTS_TO_FETCH}"
-    broadcast_data = non_mod.api.get_ndjson(ApiType.ApiBroadcast, url, non_mod.token)
-    for broadcast in broadcast_data:
+    for broadcast in non_mod.api.iter_ndjson(ApiType.ApiBroadcast, url, non_mod.token):
         try:
             broadcast_name = broadcast['tour']['name']
             for r in broadcast['rounds']:
@@ -1,11 +1,17 @@
 import os
+import sys
 import html
+from collections import OrderedDict, defaultdict
+from threading import Lock, Timer
+import atexit
 from datetime import datetime, timedelta
 from enum import IntFlag
 from elements import STYLE_WORD_BREAK
-from chat_re import list_res, list_res_variety, re_spaces, Lang
-from database import Messages
+from chat_re import list_res, list_res_variety, re_spaces, Lang, ReEngine, ReUser, eval_rules
+from database import Messages, write_queue
 from elements import Reason, deltaseconds, get_user_comm_href, get_highlight_style, get_flair_element, log, log_exception
+from metrics import CHAT_EVAL_CACHE
+from consts import CHAT_EVAL_CACHE_SIZE, CHAT_FLAGS_FLUSH_PERIOD
 
 
 class AddButtons(IntFlag):
@@ -32,9 +38,108 @@ def load_res():
     return list_re, list_re_variety
 
 
+class EvalCache:
+    # LRU cache of evaluation results: the same texts are repeated a lot in chats and combined messages
+    # are re-evaluated on every update
+    def __init__(self, max_size=CHAT_EVAL_CACHE_SIZE):
+        self.lock = Lock()
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0  # [bytes] of the cached keys and results
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(text, t_type, re_usernames):
+        # re_usernames: only the rules of the user names mentioned in the text, see ReUser.get_mentioned()
+        return text, t_type, tuple(re_i.info for re_i in re_usernames)
+
+    @staticmethod
+    def get_size(key, result):
+        text, t_type, usernames = key
+        eval_text, scores, score, ban_points, languages = result
+        return sum(sys.getsizeof(obj) for obj in (key, text, t_type, usernames, *usernames,
+                                                  result, eval_text, scores, score, ban_points, languages))
+
+    def get(self, key):
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+                CHAT_EVAL_CACHE.inc("miss")
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                CHAT_EVAL_CACHE.inc("hit")
+            return result
+
+    def put(self, key, result):
+        with self.lock:
+            old_result = self.entries.pop(key, None)
+            if old_result is not None:
+                self.size -= EvalCache.get_size(key, old_result)
+            self.entries[key] = result
+            self.size += EvalCache.get_size(key, result)
+            while len(self.entries) > self.max_size:
+                old_key, old_result = self.entries.popitem(last=False)
+                self.size -= EvalCache.get_size(old_key, old_result)
+
+    def get_status(self):
+        with self.lock:
+            num_evals = self.hits + self.misses
+            ratio = f" ({self.hits / num_evals:.0%})" if num_evals else ""
+            return f"Chat evaluation cache: {len(self.entries):,} entries, {self.size / 1024 / 1024:.1f} MB, " \
+                   f"{self.hits:,} hits{ratio}, {self.misses:,} misses"
+
+
+class FlagUpdates:
+    # Collects the messages with changed flags (removed, disabled, timeout) and writes them in batches,
+    # CHAT_FLAGS_FLUSH_PERIOD seconds after the first change
+    def __init__(self):
+        self.lock = Lock()
+        self.messages = {}  # id(Message): Message, the message is kept alive until it is written
+        self.timer = None
+
+    def put(self, msg):
+        with self.lock:
+            self.messages[id(msg)] = msg
+            if self.timer is None:
+                self.timer = Timer(CHAT_FLAGS_FLUSH_PERIOD, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            messages = list(self.messages.values())
+            self.messages.clear()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if messages:
+            write_queue.put(FlagUpdates.update_db, messages)
+
+    @staticmethod
+    def update_db(messages):
+        # Runs in write_queue after the insertion of the messages, which sets db_id
+        ids = defaultdict(list)
+        for msg in messages:
+            if msg.db_id is not None:
+                ids[(msg.is_removed, msg.is_disabled, msg.is_timed_out)].append(msg.db_id)
+        for (removed, disabled, timeout), flag_ids in ids.items():
+            for i in range(0, len(flag_ids), 500):
+                Messages.update(removed=removed, disabled=disabled, timeout=timeout). \
+                    where(Messages.id.in_(flag_ids[i:i + 500])).execute()
+
+
+flag_updates = FlagUpdates()
+atexit.register(flag_updates.flush)  # runs before write_queue.join, which is registered earlier
+
+
 class Message:
     global_id = 1  # starting from 1
     list_res, list_res_variety = load_res()
+    re_engine = ReEngine(list_res)
+    eval_cache = EvalCache()
 
     @staticmethod
     def is_id_multi(id):
@@ -59,6 +164,7 @@ class Message:
         self.reasons = [0] * Reason.Size
         self.scores = [0] * Reason.Size
         self.languages = Lang.No
+        self.report_info = None  # state and HTML of get_report_info()
 
     def best_ban_reason(self):
         ban_sum = sum(self.reasons)
@@ -91,20 +197,33 @@ class Message:
             return
         self.is_removed = msg.is_removed
         self.is_disabled = msg.is_disabled
-        msg_db = Messages.get_or_none(id=self.db_id)
-        if msg_db:
-            msg_db.removed = self.is_removed
-            msg_db.disabled = self.is_disabled
-            msg_db.save()
+        self.tournament.num_flag_changes += 1
+        flag_updates.put(self)
 
     def set_timed_out(self, flag=True):
         if self.is_timed_out == flag:
             return
         self.is_timed_out = flag
-        msg_db = Messages.get_or_none(id=self.db_id)
-        if msg_db:
-            msg_db.timeout = self.is_timed_out
-            msg_db.save()
+        self.tournament.num_flag_changes += 1
+        flag_updates.put(self)
+
+    def set_reset(self, flag=True):
+        if self.is_reset == flag:
+            return
+        self.is_reset = flag
+        self.tournament.changed_messages.add(self.id)
+
+    def get_state(self):
+        # Everything of the message that get_info() and Tournament.process_multi_messages() depend on
+        return self.id, self.eval_text, self.score, self.languages, self.is_reset, self.is_deleted, self.is_removed, \
+            self.is_disabled, self.is_timed_out
+
+    def get_report_info(self):
+        # Same as get_info('A', add_mscore=True), rendered again only when the message has changed
+        state = self.get_state()
+        if self.report_info is None or self.report_info[0] != state:
+            self.report_info = state, self.get_info('A', add_mscore=True)
+        return self.report_info[1]
 
     def __eq__(self, other):
         return self.username.lower() == other.username.lower() and self.text == other.text \
@@ -124,22 +243,15 @@ class Message:
         try:
             # Remove multiple spaces
             text = re_spaces.sub(" ", self.text)
-            # Add usernames and evaluate
-            res_all = re_usernames.copy()
-            res_all.extend([re_i for re_i in Message.list_res
-                            if (re_i.exclude_tournaments is None or self.tournament.t_type not in re_i.exclude_tournaments)])
-            result_all = res_all[0].eval(text, res_all, 0)
-            result_variety = Message.list_res_variety[0].eval(text, Message.list_res_variety, 0)
-            ban_points_all = sum(result_all.ban_points)
-            ban_points_variety = sum(result_variety.ban_points)
-            result = result_all if ban_points_all > ban_points_variety else result_variety \
-                if ban_points_all < ban_points_variety or result_all.total_score() < result_variety.total_score() \
-                else result_all
-            self.eval_text = result.element
-            self.scores = result.scores
-            self.score = result.total_score()
-            self.reasons = result.ban_points
-            self.languages = result.languages
+            re_usernames = ReUser.get_mentioned(text, re_usernames)
+            key = EvalCache.get_key(text, self.tournament.t_type, re_usernames)
+            result = Message.eval_cache.get(key)
+            if result is None:
+                result = Message.evaluate_text(text, self.tournament.t_type, re_usernames)
+                Message.eval_cache.put(key, result)
+            self.eval_text, scores, self.score, reasons, self.languages = result
+            self.scores = scores.copy()
+            self.reasons = reasons.copy()
             if self.score >= 50:
                 self.eval_text.replace('<span class="text-warning"', '<span class="text-danger"')
                 if self.score > 60:
@@ -150,6 +262,21 @@ class Message:
             self.eval_text = html.escape(self.text)
             self.score = 0
 
+    @staticmethod
+    def evaluate_text(text, t_type, re_usernames):
+        # Add usernames and evaluate
+        res_all = re_usernames.copy()
+        res_all.extend([re_i for re_i in Message.re_engine.get_candidates(text)
+                        if (re_i.exclude_tournaments is None or t_type not in re_i.exclude_tournaments)])
+        result_all = eval_rules(text, res_all)
+        result_variety = eval_rules(text, Message.list_res_variety)
+        ban_points_all = sum(result_all.ban_points)
+        ban_points_variety = sum(result_variety.ban_points)
+        result = result_all if ban_points_all > ban_points_variety else result_variety \
+            if ban_points_all < ban_points_variety or result_all.total_score() < result_variety.total_score() \
+            else result_all
+        return result.element, result.scores, result.total_score(), result.ban_points, result.languages
+
     def is_hidden(self):
         return self.is_removed or self.is_disabled or \
                self.is_reset or self.is_timed_out or self.is_official  # or self.is_deleted
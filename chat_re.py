@@ -1,5 +1,11 @@
 import html
 import re
+import string
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
 from enum import IntFlag
 from elements import Reason, TournType, log_exception
 from elements import STYLE_WORD_BREAK
@@ -31,6 +37,30 @@ LANGUAGES = {
 }
 
 
+class Script(IntFlag):
+    No = 0
+    Latin = 2**0
+    Cyrillic = 2**1
+    Devanagari = 2**2
+
+    @staticmethod
+    def get(text):
+        if text.isascii():
+            return Script.Latin if re_scripts[Script.Latin].search(text) else Script.No
+        script = Script.No
+        for s, script_re in re_scripts.items():
+            if script_re.search(text):
+                script |= s
+        return script
+
+
+re_scripts = {
+    Script.Latin: re.compile(r'[a-z\u00C0-\u024F\u1E00-\u1EFF]', re.IGNORECASE),
+    Script.Cyrillic: re.compile(r'[\u0400-\u052F]', re.IGNORECASE),
+    Script.Devanagari: re.compile(r'[\u0900-\u097F]', re.IGNORECASE)
+}  # case-insensitive like the rules: e.g. the Kelvin sign matches 'k'
+
+
 class EvalResult:
     def __init__(self, text):
         self.scores = [0] * Reason.Size
@@ -43,13 +73,6 @@ class EvalResult:
             self.element = text
             log_exception(exception)
 
-    def __iadd__(self, o):
-        for i in range(Reason.Size):
-            self.scores[i] += o.scores[i]
-            self.ban_points[i] += o.ban_points[i]
-        self.languages |= o.languages
-        return self
-
     def total_score(self):
         return sum(self.scores)
 
@@ -64,55 +87,45 @@ class TextVariety:
         self.class_name = class_name
         self.exclude_tournaments = None
 
-    def eval(self, original_msg, res, it):
-        result = EvalResult(original_msg)
-        if not original_msg:
-            return result
+    def get_score(self, original_msg):
         text = re.sub(r'[^\w]', "", original_msg)
         text_wo_spaces = re.sub(r'[^\s]', "", original_msg)
         num_special_symbols = len(text_wo_spaces) - len(text)
         s = set(text)
+        score = 0
         if len(s) < 12:
             if len(s) in [2, 3, 4] and num_special_symbols <= 30 and '0' in s and '1' in s and len(text) >= 35:
-                result.scores[self.reason] += 50 if len(text) >= 45 else 20  # binary code
+                score += 50 if len(text) >= 45 else 20  # binary code
             elif len(s) in [2, 3, 4] and '-' in s and ('.' in s or '·' in s) and len(text) >= 35:
-                result.scores[self.reason] += 50 if len(text) >= 45 else 20  # Morse code
+                score += 50 if len(text) >= 45 else 20  # Morse code
             elif len(s) == 2 and len(text) >= 40:
-                result.scores[self.reason] += 80
+                score += 80
             elif len(s) == 3 and len(text) >= 50:
-                result.scores[self.reason] += 80
+                score += 80
             elif 3 * len(s) + 50 < len(text):
-                result.scores[self.reason] += 80
+                score += 80
             elif 3 * len(s) + 20 < len(text):
-                result.scores[self.reason] += 50
+                score += 50
             elif 3 * len(s) + 8 < len(text):
-                result.scores[self.reason] += 10
+                score += 10
             if num_special_symbols > 50:
-                result.scores[self.reason] += 80
+                score += 80
             elif num_special_symbols > 30 and num_special_symbols > 3 * len(s):
-                result.scores[self.reason] += 50
+                score += 50
             elif num_special_symbols > 15 and num_special_symbols > 3 * len(s):
-                result.scores[self.reason] += 10
+                score += 10
             if self.max_score:
-                result.scores[self.reason] = min(self.max_score, result.scores[self.reason])
-            if result.scores[self.reason] > 0:
-                is_ban = False if not self.ban else 0 < self.ban <= result.scores[self.reason]
-                info = f"[{'Suggested timeout' if is_ban else 'Reason'}]  {Reason.to_text(self.reason)}"
-                if self.info:
-                    str_lang = f"{LANGUAGES[self.lang]}: " if self.lang != Lang.No else ""
-                    info = f'{info}\n{str_lang}{self.info}'
-                result.element = f'<abbr class="{self.class_name}" title="{info}" style="{STYLE_WORD_BREAK}' \
-                                 f'text-decoration:none;">{html.escape(original_msg)}</abbr>'
-                if self.ban and self.reason != Reason.No:
-                    result.ban_points[self.reason] = result.scores[self.reason] / self.ban
-                result.languages |= self.lang
-                return result
-        it += 1
-        if it < len(res):
-            new_result = res[it].eval(original_msg, res, it)
-            result += new_result
-            result.element = new_result.element
-        return result
+                score = min(self.max_score, score)
+        return score
+
+    def format_element(self, original_msg, score):
+        is_ban = False if not self.ban else 0 < self.ban <= score
+        info = f"[{'Suggested timeout' if is_ban else 'Reason'}]  {Reason.to_text(self.reason)}"
+        if self.info:
+            str_lang = f"{LANGUAGES[self.lang]}: " if self.lang != Lang.No else ""
+            info = f'{info}\n{str_lang}{self.info}'
+        return f'<abbr class="{self.class_name}" title="{info}" style="{STYLE_WORD_BREAK}' \
+               f'text-decoration:none;">{html.escape(original_msg)}</abbr>'
 
 
 class Re:
@@ -135,10 +148,7 @@ class Re:
         self.info = info
         self.class_name = class_name
 
-    def eval(self, original_msg, res, it):
-        result = EvalResult(original_msg)
-        if not original_msg:
-            return result
+    def split(self, original_msg):
         elements = self.re.findall(original_msg)
         if self.is_capturing_groups:
             for i in range(len(elements)):
@@ -152,27 +162,20 @@ class Re:
             new_msgs.append(original_msg[j:])
         else:
             new_msgs = self.re.split(original_msg)
-        if len(new_msgs) > 1:
-            result.scores[self.reason] += self.score * (len(new_msgs) - 1)
-            result.languages |= self.lang
+        return new_msgs, elements
+
+    def get_score(self, num_elements):
+        score = self.score * num_elements if num_elements else 0
         if self.max_score:
-            result.scores[self.reason] = min(self.max_score, result.scores[self.reason])
-        is_ban = False if not self.ban else (0 < self.ban <= result.scores[self.reason]
-                                             or (self.ban < 0 and result.scores[self.reason] >= -self.ban * self.score))
-        if self.ban and self.reason != Reason.No:
-            result.ban_points[self.reason] = (result.scores[self.reason] / self.ban) if self.ban > 0 \
-                else (result.scores[self.reason] / (-self.ban * self.score))
-        it += 1
-        for i in range(len(new_msgs)):
-            if it < len(res):
-                result_i = res[it].eval(new_msgs[i], res, it)
-                new_msgs[i] = result_i.element
-                result += result_i
-            else:
-                new_msgs[i] = html.escape(new_msgs[i])
-        if len(new_msgs) == 1:
-            result.element = new_msgs[0]
-            return result
+            score = min(self.max_score, score)
+        return score
+
+    def get_ban_points(self, score):
+        return (score / self.ban) if self.ban > 0 else (score / (-self.ban * self.score))
+
+    def format_elements(self, elements, score):
+        is_ban = False if not self.ban else (0 < self.ban <= score
+                                             or (self.ban < 0 and score >= -self.ban * self.score))
         for i in range(len(elements)):
             elements[i] = html.escape(elements[i])
             if self.reason == Reason.No:
@@ -184,9 +187,7 @@ class Re:
                 str_sep = "\n" if info else ""
                 info = f'{info}{str_sep}{str_lang}{self.info}'
                 elements[i] = self.format_element(elements[i], info)
-        elements.append("")
-        result.element = "".join(f'{text}{element}' for text, element in zip(new_msgs, elements))
-        return result
+        return elements
 
     def format_element(self, element, info):
         if info:
@@ -212,6 +213,14 @@ class ReUser(Re):
     def __init__(self, str_re, score=10, max_score=None, ban=None, reason=Reason.No, info="", class_name="text-warning",
                  is_separate_word=True, is_capturing_groups=False):
         super().__init__(str_re, score, max_score, ban, reason, info, class_name, is_separate_word, is_capturing_groups)
+        # A user name can only be matched where it's found in the case-folded text
+        self.folded_name = info.translate(username_folding) if re_username.fullmatch(info) else None
+
+    @staticmethod
+    def get_mentioned(text, re_usernames):
+        # The rules of the user names that can match the text
+        folded_text = text.translate(username_folding)
+        return [re_i for re_i in re_usernames if re_i.folded_name is None or re_i.folded_name in folded_text]
 
     def format_element(self, element, info):
         i = max(element[:-1].rfind('/'), element[:-1].rfind('@'))
@@ -219,6 +228,334 @@ class ReUser(Re):
         return f'<a class="{self.class_name}" href="https://lichess.org/@/{name.lower()}" target="_blank">{element}</a>'
 
 
+def eval_rules(original_msg, res):
+    # Each rule is applied to the fragments of the text not matched by the previous rules.
+    # The text is kept as a list of pieces, HTML elements and fragments with the index of the fragment they were
+    # split from, and the rules are applied one by one to all fragments
+    result = EvalResult("")
+    pieces = [(original_msg, -1)]
+    parents = []  # fragments evaluated by the rules: index of the fragment they were split from
+    levels = []  # index of the first fragment evaluated by each rule
+    ban_points = []  # [(fragment index, reason, ban points)]
+    for rule in res:
+        levels.append(len(parents))
+        new_pieces = []
+        for piece in pieces:
+            if type(piece) is str:
+                new_pieces.append(piece)
+                continue
+            msg, parent = piece
+            if not msg:
+                continue
+            i = len(parents)
+            parents.append(parent)
+            if isinstance(rule, TextVariety):
+                score = rule.get_score(msg)
+                if score > 0:
+                    result.scores[rule.reason] += score
+                    if rule.ban and rule.reason != Reason.No:
+                        ban_points.append((i, rule.reason, score / rule.ban))
+                    result.languages |= rule.lang
+                    new_pieces.append(rule.format_element(msg, score))
+                else:
+                    new_pieces.append((msg, i))
+                continue
+            new_msgs, elements = rule.split(msg)
+            score = rule.get_score(len(new_msgs) - 1)
+            result.scores[rule.reason] += score
+            if len(new_msgs) > 1:
+                result.languages |= rule.lang
+            if rule.ban and rule.reason != Reason.No:
+                ban_points.append((i, rule.reason, rule.get_ban_points(score)))
+            if len(new_msgs) == 1:
+                new_pieces.append((msg, i))
+                continue
+            for new_msg, element in zip(new_msgs, rule.format_elements(elements, score)):
+                new_pieces.append((new_msg, i))
+                new_pieces.append(element)
+            new_pieces.append((new_msgs[-1], i))
+        pieces = new_pieces
+    # Ban points are summed up the tree of fragments from the last rule to the first one,
+    # i.e. the points of the fragments split from a fragment are added to its own points
+    levels.append(len(parents))
+    for reason in {reason for _, reason, _ in ban_points}:
+        totals = [0] * len(parents)
+        for i, points_reason, points in ban_points:
+            if points_reason == reason:
+                totals[i] = points
+        for level in range(len(levels) - 2, 0, -1):
+            for i in range(levels[level], levels[level + 1]):
+                totals[parents[i]] += totals[i]
+        result.ban_points[reason] = totals[0]
+    result.element = "".join(piece if type(piece) is str else html.escape(piece[0]) for piece in pieces)
+    return result
+
+
+class LiteralIndex:
+    def __init__(self, literals):
+        # Aho-Corasick automaton: finds all literals occurring in the text in one pass
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [set()]
+        for literal in literals:
+            state = 0
+            for c in literal:
+                if c not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(set())
+                    self.goto[state][c] = len(self.goto) - 1
+                state = self.goto[state][c]
+            self.out[state].add(literal)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for c, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and c not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(c, 0)
+                self.out[next_state] |= self.out[self.fail[next_state]]
+
+    def find(self, text):
+        found = set()
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for c in text:
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+class ReEngine:
+    group_size = 32
+    min_literal_len = 2
+    max_literals = 16
+
+    def __init__(self, rules):
+        # Rules that can't match anywhere in the text can't match any of its fragments either,
+        # and they don't change the result of the evaluation chain. So only the rules that may match are evaluated:
+        # those whose required literals occur in the text and which match the text without anchors and word boundaries
+        self.rules = rules
+        self.always = set()  # rules with lookarounds/backreferences and TextVariety can't be screened
+        self.screened = []  # [(rule index, relaxed pattern, scripts)] for rules without required literals
+        self.literal_rules = {}  # literal: [(rule index, relaxed re or None)]
+        self.routes = {}  # scripts of the text: (LiteralIndex, combined re, groups of rules)
+        literals = {}
+        for i, rule in enumerate(rules):
+            if isinstance(rule, Re):
+                rule_literals = ReEngine.get_literals(sre_parse.parse(rule.re.pattern, rule.re.flags))
+                if rule_literals and (min(len(literal) for literal in rule_literals) < ReEngine.min_literal_len
+                                      or len(rule_literals) > ReEngine.max_literals):
+                    rule_literals = None
+            else:
+                rule_literals = None
+            pattern = ReEngine.relax(rule.re.pattern) if isinstance(rule, Re) and not rule.is_capturing_groups \
+                else None
+            if rule_literals:
+                literals[i] = (rule_literals, None if pattern is None else re.compile(pattern, re.IGNORECASE))
+            elif pattern is None:
+                self.always.add(i)
+            else:
+                scripts = ReEngine.get_scripts(sre_parse.parse(rule.re.pattern, rule.re.flags))
+                self.screened.append((i, pattern, scripts))
+        self.always_rules = [rule for i, rule in enumerate(rules) if i in self.always]
+        self.case_folding = ReEngine.get_case_folding({c for rule_literals, _ in literals.values()
+                                                       for literal in rule_literals for c in literal})
+        for i, (rule_literals, rule_re) in literals.items():
+            for literal in rule_literals:
+                self.literal_rules.setdefault(literal.translate(self.case_folding), []).append((i, rule_re))
+        self.literal_scripts = {literal: Script.get(literal) for literal in self.literal_rules}
+
+    @staticmethod
+    def combine(patterns):
+        return re.compile("|".join(f"(?:{pattern})" for pattern in patterns), re.IGNORECASE) if patterns else None
+
+    @staticmethod
+    def relax(pattern):
+        # Remove anchors and word boundaries so that the pattern matches the whole text
+        # whenever the original pattern matches a part of it
+        out = []
+        i = 0
+        is_class = False
+        while i < len(pattern):
+            c = pattern[i]
+            if c == '\\':
+                esc = pattern[i:i + 2]
+                if is_class:
+                    out.append(esc)
+                elif esc[1:].isdigit():
+                    return None  # backreference
+                elif esc not in ['\\b', '\\B', '\\A', '\\Z']:
+                    out.append(esc)
+                i += 2
+                continue
+            if is_class:
+                is_class = (c != ']')
+            elif c == '[':
+                is_class = True
+                j = i + 1
+                if pattern[j:j + 1] == '^':
+                    j += 1
+                if pattern[j:j + 1] == ']':
+                    j += 1
+                out.append(pattern[i:j])
+                i = j
+                continue
+            elif c in '^$':
+                i += 1
+                continue
+            elif c == '(' and pattern.startswith(('(?=', '(?!', '(?<', '(?P='), i):
+                return None  # lookaround or backreference
+            out.append(c)
+            i += 1
+        return "".join(out)
+
+    @staticmethod
+    def get_literals(parsed):
+        # Returns a set of strings at least one of which occurs in any match, or None
+        options = []
+        run = {""}  # strings matched by the current sequence of literals
+
+        def flush(new_run):
+            if run != {""}:
+                options.append(run)
+            return new_run
+
+        for op, av in parsed:
+            if op is sre_constants.LITERAL:
+                run = {s + chr(av) for s in run}
+                continue
+            if op is sre_constants.AT:
+                continue  # zero-width
+            if op is sre_constants.IN and len(av) * len(run) <= ReEngine.max_literals \
+                    and all(item_op is sre_constants.LITERAL for item_op, _ in av):
+                run = {s + chr(c) for s in run for _, c in av}
+                continue
+            if op in [sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT] and av[0] >= 1 \
+                    and len(av[2]) == 1 and av[2][0][0] is sre_constants.LITERAL:
+                c = chr(av[2][0][1])
+                run = {s + c * av[0] for s in run}
+                if av[1] != av[0]:
+                    run = flush({c})  # more of the same character may follow
+                continue
+            run = flush({""})
+            if op is sre_constants.SUBPATTERN:
+                literals = ReEngine.get_literals(av[-1])
+            elif op is sre_constants.BRANCH:
+                literals = set()
+                for branch in av[1]:
+                    branch_literals = ReEngine.get_literals(branch)
+                    if not branch_literals:
+                        literals = None
+                        break
+                    literals |= branch_literals
+            elif op in [sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT] and av[0] >= 1:
+                literals = ReEngine.get_literals(av[2])
+            else:
+                literals = None
+            if literals:
+                options.append(literals)
+        flush({""})
+        if not options:
+            return None
+        return max(options, key=lambda literals: (min(len(literal) for literal in literals), -len(literals)))
+
+    @staticmethod
+    def get_scripts(parsed):
+        # Returns the scripts at least one of which any match contains a character of, or Script.No if unknown
+        best = Script.No
+        for op, av in parsed:
+            scripts = Script.No
+            if op is sre_constants.LITERAL:
+                scripts = Script.get(chr(av))
+            elif op is sre_constants.IN:
+                for item_op, item_av in av:
+                    if item_op is sre_constants.LITERAL:
+                        item_scripts = Script.get(chr(item_av))
+                    elif item_op is sre_constants.RANGE:
+                        item_scripts = Script.get(chr(item_av[0]))
+                        if any(Script.get(chr(c)) != item_scripts for c in range(item_av[0] + 1, item_av[1] + 1)):
+                            item_scripts = Script.No
+                    else:
+                        item_scripts = Script.No
+                    if item_scripts == Script.No:
+                        scripts = Script.No
+                        break
+                    scripts |= item_scripts
+            elif op is sre_constants.SUBPATTERN:
+                scripts = ReEngine.get_scripts(av[-1])
+            elif op is sre_constants.BRANCH:
+                for branch in av[1]:
+                    branch_scripts = ReEngine.get_scripts(branch)
+                    if branch_scripts == Script.No:
+                        scripts = Script.No
+                        break
+                    scripts |= branch_scripts
+            elif op in [sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT] and av[0] >= 1:
+                scripts = ReEngine.get_scripts(av[2])
+            if scripts != Script.No and (best == Script.No or bin(scripts).count("1") < bin(best).count("1")):
+                best = scripts
+        return best
+
+    @staticmethod
+    def get_case_folding(chars):
+        # Maps all characters that match one of the characters case-insensitively to the same character
+        if not chars:
+            return {}
+        all_chars = "".join(chr(i) for i in range(0x10000) if not 0xD800 <= i < 0xE000)
+        class_re = re.compile(f"[{''.join(re.escape(c) for c in chars)}]", re.IGNORECASE)
+        char_res = {c: re.compile(re.escape(c), re.IGNORECASE) for c in chars}
+        folding = {}
+        for c in sorted(set(class_re.findall(all_chars))):
+            equal_chars = [ch for ch, char_re in char_res.items() if char_re.fullmatch(c)]
+            folding[ord(c)] = min(folding.get(ord(ch), ch) for ch in equal_chars)
+            for ch in equal_chars:
+                folding[ord(ch)] = folding[ord(c)]
+        return folding
+
+    def get_route(self, scripts):
+        # Rules needing scripts not present in the text can't match it: e.g. Cyrillic and Hindi rules
+        # are skipped for a Latin text
+        route = self.routes.get(scripts)
+        if route is None:
+            literal_index = LiteralIndex([literal for literal, literal_scripts in self.literal_scripts.items()
+                                          if literal_scripts & ~scripts == 0])
+            screened = [(i, pattern) for i, pattern, rule_scripts in self.screened
+                        if rule_scripts == Script.No or rule_scripts & scripts]
+            groups = []
+            for j in range(0, len(screened), ReEngine.group_size):
+                group = screened[j:j + ReEngine.group_size]
+                groups.append((ReEngine.combine([pattern for _, pattern in group]),
+                               [(i, re.compile(pattern, re.IGNORECASE)) for i, pattern in group]))
+            route = literal_index, ReEngine.combine([pattern for _, pattern in screened]), groups
+            self.routes[scripts] = route
+        return route
+
+    def get_candidates(self, text):
+        indices = set(self.always)
+        checked = set()
+        literal_index, gate, groups = self.get_route(Script.get(text))
+        for literal in literal_index.find(text.translate(self.case_folding)):
+            for i, rule_re in self.literal_rules[literal]:
+                if i not in checked:
+                    checked.add(i)
+                    if rule_re is None or rule_re.search(text):
+                        indices.add(i)
+        if gate is not None and gate.search(text):
+            for combined_re, group in groups:
+                if combined_re.search(text):
+                    indices.update(i for i, rule_re in group if rule_re.search(text))
+        if len(indices) == len(self.always):
+            return self.always_rules
+        return [self.rules[i] for i in sorted(indices)]
+
+
 list_res_variety = {
 Lang.Spam: [
     TextVariety(reason=Reason.Spam, ban=80, info="TextVariety")
@@ -1254,3 +1591,5 @@ Lang.Spam: [
 }
 
 re_spaces = re.compile(r'\s{2,}', re.IGNORECASE)
+re_username = re.compile(r"[\w-]+", re.ASCII)
+username_folding = ReEngine.get_case_folding(set(string.ascii_letters + string.digits + "_-"))
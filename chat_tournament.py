@@ -1,15 +1,38 @@
 from datetime import datetime, timedelta
 from dateutil import tz
 import json
+from bisect import bisect_left
 from elements import Reason, TournType, deltaseconds, delta_s, deltaperiod, get_client_id, shorten, add_timeout_msg, get_user_comm_href
 from elements import log, log_exception, Error500
 from chat_re import ReUser, Lang
 from chat_message import Message
 from api import ApiType
-from database import Messages, db
+from database import Messages, write_queue
 from consts import *
 
 
+class UserMessages:
+    # Messages of a user posted in a row or with short intervals, see Tournament.update_user_messages()
+    def __init__(self, user_name):
+        self.user_name = user_name
+        self.msgs = []  # None: messages of other users in between
+        self.is_changed = True
+        self.text = ""  # combined text
+        self.key = None  # signature of the messages and the user names mentioned
+        self.output = None  # result of Tournament.process_multi_messages() for the key
+        self.result = None  # num_msgs, real_msgs, *output if to be reported
+
+    def remove_first(self, msg):
+        i = 0
+        while self.msgs[i] is not msg:  # not index(): Message.__eq__() compares the texts
+            i += 1
+        i += 1
+        while i < len(self.msgs) and self.msgs[i] is None:
+            i += 1
+        del self.msgs[:i]
+        self.is_changed = True
+
+
 class Tournament:
     def __init__(self, tourney, t_type, link="", is_monitored=False):
         self.t_type = t_type
@@ -41,6 +64,8 @@ class Tournament:
             self.name = f"Swiss {tourney['name']}" if t_type == TournType.Swiss else tourney['name']
             self.finishesAt = (tourney['status'] == 'finished')
         self.messages = []
+        self.messages_offset = 0  # position of self.messages[0] in self.message_index
+        self.message_index = {}  # (username, text): ascending positions of the messages
         self.user_names = set()
         self.user_flairs = {}
         self.re_usernames = []
@@ -49,6 +74,7 @@ class Tournament:
         self.last_error_404: datetime = None
         self.max_score = 0
         self.total_score = 0
+        self.sus_score = 0  # max_score of the recent downloads, halved with every download
         self.is_monitored = is_monitored
         self.is_enabled = True
         self.link = link
@@ -58,6 +84,19 @@ class Tournament:
         self.multiline_reports = ""
         self.is_sync_with_db = False
         self.keep_max_messages = False
+        self.num_flag_changes = 0  # of the messages, see Message.update()
+        self.changed_messages = set()  # IDs of the messages changed since update_user_messages()
+        self.frequent_offset = None  # messages_offset at the time of update_user_messages()
+        self.frequent_num_flag_changes = 0
+        self.frequent_msgs = []  # messages processed by update_user_messages()
+        self.frequent_usernames = set()  # of re_usernames at the time of update_user_messages()
+        self.first_msg_time: datetime = None
+        self.closed_user_msgs = []
+        self.open_user_msgs = {}  # username: UserMessages
+        self.user_msgs_by_id = {}  # message ID: UserMessages
+        self.last_user = ""
+        self.frequent_results = {}  # signature of the messages of a user: result of process_multi_messages()
+        self.reports_cache = None  # header, errors, messages and HTML of get_info()
 
     def update(self, tourn):
         self.startsAt = tourn.startsAt
@@ -143,19 +182,62 @@ class Tournament:
         delta_min = deltaseconds(self.startsAt, now_utc) // 60
         return max(2, (delta_min - len(self.messages)) // 10)
 
+    def num_recent_messages(self, now_utc):
+        num_msgs = 0
+        for msg in reversed(self.messages):
+            if delta_s(now_utc, msg.time) >= CHAT_ACTIVITY_PERIOD:
+                break
+            num_msgs += 1
+        return num_msgs
+
+    def next_update_period(self, now_utc, refresh_period):
+        # update_period() adapted to the chat activity, the suspicious messages and the errors
+        # [chat refreshes of refresh_period seconds]
+        period = self.update_period(now_utc)
+        if self.is_monitored:
+            return period
+        num_msgs = self.num_recent_messages(now_utc)
+        if num_msgs >= CHAT_BUSY_NUM_MSGS or self.sus_score >= CHAT_FREQUENT_MSGS_MIN_SCORE[0]:
+            period = max(1, period // 4)
+        elif num_msgs:
+            period = max(1, period // 2)
+        elif self.last_update is not None:
+            period = max(CHAT_QUIET_UPDATE_PERIOD, period) if self.is_ongoing(now_utc) else 2 * period
+        if self.is_created(now_utc):
+            period = min(period, max(1, -(-deltaseconds(self.startsAt, now_utc) // refresh_period)))
+        if self.last_error_404 is not None:
+            delay = DELAY_ERROR_CHAT_404 - deltaseconds(now_utc, self.last_error_404)
+            period = max(period, -(-delay // refresh_period))
+        if self.errors_500 and self.errors_500[-1].is_ongoing():
+            period = max(period, -(-DELAY_ERROR_CHAT_500 // refresh_period))
+        return period
+
     def get_endpoint(self):
         return "tournament" if self.t_type == TournType.Arena else "swiss" if self.t_type == TournType.Swiss else ""
 
     def download(self, msg_lock, now_utc, room_mod):
+        new_messages, request = self.prepare_download(now_utc, room_mod)
+        if request is None:
+            return new_messages, []
+        method, api, url, token, kwargs = request
+        try:
+            r = room_mod.api.request(method, api, url, token, **kwargs)
+        except Exception as exception:
+            r = exception
+        return self.process_download(request, r, msg_lock, now_utc, new_messages)
+
+    def prepare_download(self, now_utc, room_mod):
+        # Returns the messages loaded from the DB and the request to download the chat
+        # (method, api, url, token, kwargs), or None if the chat shouldn't be downloaded now
         new_messages = []
-        deleted_messages = []
         if self.errors or self.is_error_404_recently(now_utc):
-            return new_messages, deleted_messages
+            return new_messages, None
         try:
             db_messages = []
             if not self.is_sync_with_db:
-                for msg in Messages.select().where(Messages.tournament == self.id).order_by(-Messages.time, -Messages.id). \
-                            limit(CHAT_MAX_NUM_MSGS):
+                write_queue.join()
+                for msg in Messages.select().where(Messages.get_tournament_where(self.id)). \
+                        order_by(-Messages.time, -Messages.id).limit(CHAT_MAX_NUM_MSGS):
                     data = {'u': msg.username, 't': msg.text, 'r': msg.removed, 'd': msg.disabled}
                     msg_time = msg.time.replace(tzinfo=tz.tzutc())
                     db_messages.append(Message(data, self, msg_time, msg.delay, msg.id, msg.timeout))
@@ -167,13 +249,26 @@ class Tournament:
                 self.is_sync_with_db = True
             if room_mod.token:
                 url = f"https://lichess.org/api/room/{self.id}/chat"
-                r = room_mod.api.get(ApiType.ApiRoomChat, url, token=room_mod.token)
-            else:
-                headers = {'User-Agent': "litools"}
-                url = self.link if self.link else f"https://lichess.org/{self.get_endpoint()}/{self.id}"
-                if url and self.t_type == TournType.Study:
-                    url = f"{url}#players"
-                r = room_mod.api.get(ApiType.TournamentId, url, token=None, headers=headers)
+                return new_messages, ("GET", ApiType.ApiRoomChat, url, room_mod.token, {})
+            headers = {'User-Agent': "litools"}
+            url = self.link if self.link else f"https://lichess.org/{self.get_endpoint()}/{self.id}"
+            if url and self.t_type == TournType.Study:
+                url = f"{url}#players"
+            return new_messages, ("GET", ApiType.TournamentId, url, None, {'headers': headers})
+        except Exception as exception:
+            log_exception(exception)
+            self.errors.append(f"{now_utc:%Y-%m-%d %H:%M} UTC: {exception}")
+        except:
+            self.errors.append(f"ERROR at {now_utc:%Y-%m-%d %H:%M} UTC")
+        self.update_re_usernames()
+        return new_messages, None
+
+    def process_download(self, request, r, msg_lock, now_utc, new_messages):
+        # r: response to the request from prepare_download or the exception raised by it
+        deleted_messages = []
+        try:
+            if isinstance(r, Exception):
+                raise r
             if r.status_code != 200:
                 if r.status_code >= 500:
                     if self.errors_500 and self.errors_500[-1].is_ongoing():
@@ -184,17 +279,18 @@ class Tournament:
                     if self.last_error_404 is None:
                         self.last_error_404 = now_utc
                     return new_messages, deleted_messages
-                raise Exception(f"Failed to download {url}<br>Status Code {r.status_code}")
+                raise Exception(f"Failed to download {request[2]}<br>Status Code {r.status_code}")
             self.last_error_404 = None
             if self.errors_500 and self.errors_500[-1].is_ongoing():
                 self.errors_500[-1].complete(now_utc)
             delay = None if self.last_update is None else deltaseconds(now_utc, self.last_update)
             with msg_lock:
-                if room_mod.token:
+                if request[1] is ApiType.ApiRoomChat:
                     newest_messages, deleted_messages = self.process_room_messages(r, now_utc, delay)
                 else:
                     newest_messages, deleted_messages = self.process_tourn_messages(r.text, now_utc, delay)
-                Tournament.update_db(newest_messages)
+            if newest_messages:
+                write_queue.put(Tournament.update_db, newest_messages)
             new_messages.extend(newest_messages)
             self.last_update = now_utc
         except Exception as exception:
@@ -202,11 +298,14 @@ class Tournament:
             self.errors.append(f"{now_utc:%Y-%m-%d %H:%M} UTC: {exception}")
         except:
             self.errors.append(f"ERROR at {now_utc:%Y-%m-%d %H:%M} UTC")
+        self.update_re_usernames()
+        return new_messages, deleted_messages
+
+    def update_re_usernames(self):
         self.re_usernames = []  # TODO: initialize with user names of tournament players (fetch once?)
         for user in self.user_names:
             re_user = r"(https?:\/\/)?(lichess\.org\/)?@?\/?" + user
             self.re_usernames.append(ReUser(re_user, 0, info=user, class_name="text-muted"))
-        return new_messages, deleted_messages
 
     def update_reports(self, now_utc, reset_multi_messages):
         self.reports = self.get_info(now_utc)
@@ -266,8 +365,28 @@ class Tournament:
             i_cut = len(self.messages) - max_num_msgs
             deleted_messages = self.messages[:i_cut]
             self.messages = self.messages[i_cut:]
+            for msg in deleted_messages:
+                key = Tournament.get_message_key(msg)
+                positions = self.message_index[key]
+                positions.pop(0)  # the oldest message with this key
+                if not positions:
+                    del self.message_index[key]
+            self.messages_offset += i_cut
         return deleted_messages
 
+    @staticmethod
+    def get_message_key(msg):
+        return msg.username.lower(), msg.text  # same as Message.__eq__ within a tournament
+
+    def find_message(self, msg, i_start):
+        # Index of the first message equal to msg in self.messages[i_start:] or None
+        positions = self.message_index.get(Tournament.get_message_key(msg))
+        if positions:
+            i = bisect_left(positions, self.messages_offset + i_start)
+            if i < len(positions):
+                return positions[i] - self.messages_offset
+        return None
+
     def add_messages(self, messages, can_be_old=True):
         new_messages = []
         do_detect_deleted = True
@@ -275,22 +394,23 @@ class Tournament:
         is_new = True
         for msg in messages:
             if can_be_old:
-                is_new = True
-                for i in range(i_msg, len(self.messages)):
-                    if msg == self.messages[i]:
-                        i_msg = i + 1
-                        is_new = False
-                        self.messages[i].update(msg)
-                        if do_detect_deleted:
-                            for j in range(i - 1, -1, -1):
-                                if self.messages[j].is_deleted:
-                                    break
-                                self.messages[j].is_deleted = True
-                            do_detect_deleted = False
-                        break
+                i = self.find_message(msg, i_msg)
+                is_new = (i is None)
+                if not is_new:
+                    i_msg = i + 1
+                    self.messages[i].update(msg)
+                    if do_detect_deleted:
+                        for j in range(i - 1, -1, -1):
+                            if self.messages[j].is_deleted:
+                                break
+                            self.messages[j].is_deleted = True
+                            self.changed_messages.add(self.messages[j].id)
+                        do_detect_deleted = False
             if is_new:
                 msg.id = Message.global_id
                 Message.global_id += 1
+                self.message_index.setdefault(Tournament.get_message_key(msg), []) \
+                    .append(self.messages_offset + len(self.messages))
                 self.messages.append(msg)
                 new_messages.append(msg)
                 if not msg.is_official:
@@ -300,21 +420,26 @@ class Tournament:
 
     @staticmethod
     def update_db(new_messages):
-        with db.atomic():
-            for msg in new_messages:
-                msg_db = Messages.create(time=msg.time.replace(tzinfo=None), delay=msg.delay, username=msg.username,
-                                         text=msg.text, removed=msg.is_removed, disabled=msg.is_disabled,
-                                         timeout=msg.is_timed_out, tournament=msg.tournament.id)
-                msg.db_id = msg_db.id
+        # Runs in write_queue: the IDs of the rows inserted by one statement are consecutive
+        for i in range(0, len(new_messages), 100):
+            batch = new_messages[i:i + 100]
+            rows = [{'time': msg.time.replace(tzinfo=None), 'delay': msg.delay, 'username': msg.username,
+                     'text': msg.text, 'removed': msg.is_removed, 'disabled': msg.is_disabled,
+                     'timeout': msg.is_timed_out, 'tournament': msg.tournament.id} for msg in batch]
+            last_id = Messages.insert_many(rows).execute()
+            for db_id, msg in enumerate(batch, last_id - len(batch) + 1):
+                msg.db_id = db_id
 
     def set_max_messages(self, flag, chat):
         old_flag = self.keep_max_messages
         self.keep_max_messages = flag
         if flag:
+            write_queue.join()
             if not self.messages or self.messages[0].db_id is None:
                 raise Exception(f"No messages to load. Tournament ID: {self.id}")
             db_messages = []
-            for msg in Messages.select().where((Messages.tournament == self.id) & (Messages.id < self.messages[0].db_id)). \
+            for msg in Messages.select().where(Messages.get_tournament_where(self.id)
+                                               & (Messages.id < self.messages[0].db_id)). \
                     order_by(-Messages.time, -Messages.id).limit(CHAT_MAX_NUM_OLD_MSGS):
                 data = {'u': msg.username, 't': msg.text, 'r': msg.removed, 'd': msg.disabled}
                 old_msg = Message(data, self, msg.time.replace(tzinfo=tz.tzutc()), msg.delay, msg.id, msg.timeout)
@@ -326,6 +451,8 @@ class Tournament:
                     msg.id = Message.global_id
                     Message.global_id += 1
                     self.messages.insert(0, msg)
+                    self.messages_offset -= 1
+                    self.message_index.setdefault(Tournament.get_message_key(msg), []).insert(0, self.messages_offset)
                     msg.dont_evaluate()
                     new_messages.append(msg)
                     if not msg.is_official:
@@ -337,8 +464,11 @@ class Tournament:
             chat.sync_messages(self.id, [], deleted_messages)
 
     def set_enabled(self, flag, chat):
+        was_enabled = self.is_enabled
         self.is_enabled = flag
-        if not flag:
+        if flag and not was_enabled:
+            chat.schedule_chat(self.id)
+        elif not flag:
             self.set_max_messages(False, chat)
 
     def is_more(self):
@@ -362,6 +492,8 @@ class Tournament:
         self.total_score = 0
         to_timeout = {}
         for msg in self.messages[:-CHAT_MAX_NUM_MSGS]:
+            if msg.score != 0:
+                self.changed_messages.add(msg.id)
             msg.dont_evaluate()
         for msg in self.messages[-CHAT_MAX_NUM_MSGS:]:
             if msg.score is not None:
@@ -377,6 +509,7 @@ class Tournament:
                 if not msg.is_hidden():
                     if msg.best_ban_reason() != Reason.No:
                         add_timeout_msg(to_timeout, msg)
+        self.sus_score = max(self.max_score, self.sus_score // 2)
         #self.process_usernames(r.text)  # doesn't work with token
         return to_timeout
 
@@ -409,7 +542,7 @@ class Tournament:
         return f'<abbr title="Started {deltaperiod(now_utc, self.startsAt)} ago" class="text-muted">Finished</abbr>'
 
     def get_info(self, now_utc):
-        msgs = [msg.get_info('A', add_mscore=True) for msg in self.messages if msg.score and not msg.is_hidden()]
+        msgs = [msg.get_report_info() for msg in self.messages if msg.score and not msg.is_hidden()]
         if not msgs and not self.errors and not self.errors_500:
             return ""
         errors = self.errors.copy()
@@ -424,8 +557,11 @@ class Tournament:
                     f'onclick="clear_errors(\'{self.id}\');">Clear errors</button></div>' if errors else ""
         errors = f'<div class="d-flex text-warning justify-content-between px-1"><div>{"<br>".join(errors)}</div>' \
                  f'{btn_clear}</div>' if errors else ""
-        return f'<div class="col rounded m-1 px-0" style="background-color:rgba(128,128,128,0.2);min-width:350px">' \
-               f'{header}{errors}{"".join(msgs)}</div>'
+        if self.reports_cache is None or self.reports_cache[:3] != (header, errors, msgs):
+            info = f'<div class="col rounded m-1 px-0" ' \
+                   f'style="background-color:rgba(128,128,128,0.2);min-width:350px">{header}{errors}{"".join(msgs)}</div>'
+            self.reports_cache = header, errors, msgs, info
+        return self.reports_cache[3]
 
     def clear_errors(self):
         self.errors.clear()
@@ -434,183 +570,266 @@ class Tournament:
     def process_frequent_data(self, now_utc, reset_multi_messages):
         if not self.messages:
             return [], {}
+        self.update_user_messages()
         output = []
         multi_messages = {}
-        user_msgs = {}
         to_timeout = {}
-        first_msg_time = self.messages[0].time  # time of the first message in the tournament
-
-        def process_user(user_name):
-            nonlocal output, multi_messages, user_msgs, to_timeout, first_msg_time
-            msgs = user_msgs[user_name]
-            num_not_reset_messages = len([um for um in msgs if um is not None and not um.is_reset])
-            if num_not_reset_messages <= 1:
-                return
-            # Detect messages with unknown time (received at startup)
-            i = 0
-            num_first_messages = 0
-            for um in msgs:
-                if um is not None:
-                    if delta_s(um.time, first_msg_time) >= max(1.0, API_TOURNEY_PAGE_DELAY):
-                        break
-                    num_first_messages += 1
-                i += 1
-            if i > 0 and num_first_messages < NUM_FREQUENT_MESSAGES:
-                msgs = msgs[i:]
-                j = 0
-                for um in msgs:
-                    if um is not None:
-                        break
-                    j += 1
-                if j > 0:
-                    msgs = msgs[j:]
-            real_msgs = [um for um in msgs if (um is not None and um.delay is not None
-                                               and um.text.lower() not in STD_SHORT_MESSAGES)]
-            if not real_msgs:
-                return
-            num_msgs = len(real_msgs)
+        for user_msgs in self.closed_user_msgs + list(self.open_user_msgs.values()):
+            if user_msgs.is_changed:
+                self.process_user_messages(user_msgs)
+            if user_msgs.result is None:
+                continue
+            num_msgs, real_msgs, timeout_msg, report = user_msgs.result
             if num_msgs < NUM_FREQUENT_MESSAGES and delta_s(now_utc, self.last_update) > MAX_TIME_FREQUENT_MESSAGES:
-                return
-            # Process messages
+                continue
             msgs_id = real_msgs[-1].id
-            if num_msgs <= 1 or msgs_id in reset_multi_messages:
-                return
-            # Check how short the messages are and how many
-            score_int = max(0, (num_msgs - 3) * 5) if num_msgs <= 8 else num_msgs * 5
-            if len(real_msgs) >= 3:
-                lengths = [len(um.text) for um in real_msgs]
-                mean_len = (sum(lengths) - max(lengths)) / (len(lengths) - 1)
-                len_real_msgs = len(real_msgs) if self.t_type == TournType.Study else (2 * len(real_msgs) - len(msgs))
-                if len_real_msgs >= 8:
-                    coef = 20 if mean_len < 3 else 15 if mean_len < 4 else 10 if mean_len < 5 else 5 if mean_len < 6 \
-                              else 2 if mean_len < 10 else 1.5 if mean_len < 15 else 1
-                elif len_real_msgs >= 5:
-                    coef = 5 if mean_len < 3 else 4 if mean_len < 4 else 2 if mean_len < 5 else 1.5 if mean_len < 10 else 1
-                else:
-                    coef = 1
-                t_1 = real_msgs[0].time - timedelta(seconds=real_msgs[0].delay)
-                t_9 = real_msgs[min(len(real_msgs) - 1, 9)].time
-                dt = deltaseconds(t_9, t_1)
-                coef_decrease = max(1, min(10, dt / 60))
-                score_int = int(score_int * coef / coef_decrease)
-            combined_text = " ".join([m.text for m in real_msgs])
-            combined_msg = Message({'u': user_name, 't': combined_text}, real_msgs[-1].tournament, real_msgs[-1].time)
-            combined_msg.id = -msgs_id  # for recommended_timeouts
-            max_score = max([(0 if m.score is None else m.score) for m in real_msgs])
-            combined_msg.evaluate(self.re_usernames)
-            best_ban_reason = combined_msg.best_ban_reason()
-            if best_ban_reason != Reason.No or score_int > MULTI_MSG_MIN_TIMEOUT_SCORE:
-                combined_msg.text = f'[multiline] {" | ".join([m.text for m in real_msgs])}'
-                if score_int > MULTI_MSG_MIN_TIMEOUT_SCORE:
-                    combined_msg.reasons[Reason.Spam] = score_int / MULTI_MSG_MIN_TIMEOUT_SCORE
-                    combined_msg.score = score_int
-                    combined_msg.languages |= Lang.Spam
-                else:
-                    sum_len = sum([len(m.text) for m in real_msgs]) + len(real_msgs) - 1
-                    if sum_len > MAX_LEN_TEXT:
-                        enumerated_msgs = [(i, m) for i, m in enumerate(real_msgs)]
-                        enumerated_msgs.sort(key=lambda im: im[1].score * 999 - len(im[1].text), reverse=True)
-                        reported_msgs = [False] * len(real_msgs)
-                        total_len = 0
-                        last_msg = ""
-                        for i, um in enumerated_msgs:
-                            total_len += len(um.text)
-                            if total_len > MAX_LEN_TEXT and total_len != len(um.text):
-                                last_msg = um.text
-                                break
-                            reported_msgs[i] = True
-                            total_len += 1  # whitespace
-                        combined_msg.text = f'[multiline] ' \
-                                            f'{" | ".join([m.text for i, m in enumerate(real_msgs) if reported_msgs[i]])}'
-                        if last_msg:
-                            combined_msg.text = f"{combined_msg.text} | {last_msg}"  # add to the end to further shorten it
-                add_timeout_msg(to_timeout, combined_msg)
+            if msgs_id in reset_multi_messages:
+                continue
+            if timeout_msg is not None:
+                add_timeout_msg(to_timeout, timeout_msg)
                 if DO_AUTO_TIMEOUTS:
-                    return
-            # Add scores
-            best_reason = best_ban_reason if best_ban_reason != Reason.No else combined_msg.best_score_reason()
-            final_score = f'<abbr title="{num_msgs} messages in a row or in a short period of time">{score_int}</abbr>'
-            if combined_msg.score > max_score:
-                prev = final_score if score_int > 0 else ""
-                if best_reason != Reason.No:
-                    final_score = f'{prev}+<abbr title="{Reason.to_text(best_reason)}">{combined_msg.score}</abbr>'
-                else:
-                    final_score = f'{prev}+{combined_msg.score}'
-                score_int += combined_msg.score
-            if score_int < CHAT_FREQUENT_MSGS_MIN_SCORE[0] or (score_int < CHAT_FREQUENT_MSGS_MIN_SCORE[1] and num_msgs < 5):
-                return
-            tag = 'B'
-            score_theme = ' class="text-danger"' if score_int > 50 else ' class="text-warning"' if score_int > 10 else ""
-            score = f'<span{score_theme}>{final_score}</span>'
-            user = f'<a class="text-info" href="{get_user_comm_href(user_name)}" target="_blank">{user_name}</a>'
-            button_dismiss = f'<button class="btn btn-primary align-baseline flex-grow-0 px-1 py-0" ' \
-                             f'onclick="set_multi_ok(\'{tag}{msgs_id}\')">Dismiss</button>'
-            if best_reason == Reason.No:
-                best_reason = int(Reason.Spam)
-            r = Reason.to_Tag(best_reason)
-            class_ban = "btn-warning" if combined_msg.score >= 50 else "btn-success"
-            button_ban = f'<button class="btn {class_ban} nav-item dropdown-toggle align-baseline mr-1 px-1 py-0" ' \
-                         f'data-toggle="dropdown" aria-haspopup="true" aria-expanded="false" style="cursor:pointer;">' \
-                         f'Ban</button><span class="dropdown-menu" style="">' \
-                         f'<button class="dropdown-item btn-primary" onclick="timeout_multi(\'{tag}{msgs_id}\', 1);">' \
-                         f'{combined_msg.format_reason(Reason.Shaming, "Public Shaming", Reason.Spam, best_reason)}</button>' \
-                         f'<button class="dropdown-item btn-primary" onclick="timeout_multi(\'{tag}{msgs_id}\', 2);">' \
-                         f'{combined_msg.format_reason(Reason.Offensive, "Offensive Language", Reason.Spam, best_reason)}</button>' \
-                         f'<button class="dropdown-item btn-primary" onclick="timeout_multi(\'{tag}{msgs_id}\', 3);">' \
-                         f'{combined_msg.format_reason(Reason.Spam, "Spamming", Reason.Spam, best_reason)}</button>' \
-                         f'<button class="dropdown-item btn-primary" onclick="timeout_multi(\'{tag}{msgs_id}\', 4);">' \
-                         f'{combined_msg.format_reason(Reason.Other, "Inappropriate Behaviour", Reason.Spam, best_reason)}</button>' \
-                         f'</span>'
-            if best_ban_reason != Reason.No or combined_msg.score >= 50:
-                button_ban = f'<button class="btn btn-danger align-baseline flex-grow-0 py-0 px-1" ' \
-                             f'onclick="timeout_multi(\'{tag}{msgs_id}\', {int(best_reason)});">{r}</button>{button_ban}'
+                    continue
+            if report is None:
+                continue
+            score_int, header_2, msgs_info = report
             header_1 = f'<div class="d-flex justify-content-between">{self.get_link()}' \
                        f'<span class="ml-1">{self.get_status(now_utc)}</span></div>'
-            header_2 = f'<div class="d-flex justify-content-between mb-1"><span>{button_ban}{user}</span>' \
-                       f'<span class="align-items-baseline ml-1">{score} {button_dismiss}</span></div>'
             header = f'<div class="user-select-none px-1" style="background-color:rgba(128,128,128,0.2);">' \
                      f'{header_1}{header_2}</div>'
-            msgs_info = [HR if m is None else m.get_info(tag, show_hidden=True, add_user=False, rename_dismiss="Exclude",
-                                                         add_reason=Reason.Spam) for m in msgs]
-            info = f'<div id="mmsg{tag}{msgs_id}" data-mscore={score_int} class="col rounded m-1 px-0 pb-1" ' \
-                   f'style="background-color:rgba(128,128,128,0.2);min-width:350px;">{header}{"".join(msgs_info)}</div>'
+            info = f'<div id="mmsgB{msgs_id}" data-mscore={score_int} class="col rounded m-1 px-0 pb-1" ' \
+                   f'style="background-color:rgba(128,128,128,0.2);min-width:350px;">{header}{msgs_info}</div>'
             output.append((score_int, info))
             multi_messages[msgs_id] = [m for m in real_msgs]
+        self.frequent_results.clear()
+        self.multiline_reports = output
+        return multi_messages, to_timeout
 
-        def get_last_time(user_name):
-            for um in reversed(user_msgs[user_name]):
+    def update_user_messages(self):
+        # The groups of the messages of each user are updated with the messages added since the previous call.
+        # They are rebuilt only if messages have been inserted at the front or the flags of the messages have changed.
+        if self.frequent_offset is None or self.messages_offset < self.frequent_offset \
+                or self.frequent_num_flag_changes != self.num_flag_changes:
+            if self.frequent_offset is None or self.messages_offset < self.frequent_offset:
+                self.first_msg_time = self.messages[0].time
+            for user_msgs in self.closed_user_msgs + list(self.open_user_msgs.values()):
+                if user_msgs.key is not None:
+                    self.frequent_results[user_msgs.key] = user_msgs.output
+            self.changed_messages.clear()
+            self.frequent_msgs = []
+            self.closed_user_msgs = []
+            self.open_user_msgs = {}
+            self.user_msgs_by_id = {}
+            self.last_user = ""
+            self.frequent_usernames = {re_i.info for re_i in self.re_usernames}
+        else:
+            # Drop the messages deleted by delete_old_messages() from the groups
+            num_deleted = self.messages_offset - self.frequent_offset
+            if num_deleted > 0:
+                is_empty = False
+                for msg in self.frequent_msgs[:num_deleted]:
+                    user_msgs = self.user_msgs_by_id.pop(msg.id, None)
+                    if user_msgs is not None:
+                        user_msgs.remove_first(msg)
+                        is_empty = is_empty or not user_msgs.msgs
+                del self.frequent_msgs[:num_deleted]
+                if is_empty:
+                    self.closed_user_msgs = [user_msgs for user_msgs in self.closed_user_msgs if user_msgs.msgs]
+                    for username in [username for username, user_msgs in self.open_user_msgs.items()
+                                     if not user_msgs.msgs]:
+                        del self.open_user_msgs[username]
+            while self.changed_messages:  # pop(): the messages can be changed by other threads
+                user_msgs = self.user_msgs_by_id.get(self.changed_messages.pop())
+                if user_msgs is not None:
+                    user_msgs.is_changed = True
+            # New user names can change the evaluation of the groups mentioning them
+            if len(self.re_usernames) != len(self.frequent_usernames):
+                new_usernames = [re_i for re_i in self.re_usernames if re_i.info not in self.frequent_usernames]
+                self.frequent_usernames = {re_i.info for re_i in self.re_usernames}
+                if new_usernames:
+                    for user_msgs in self.closed_user_msgs + list(self.open_user_msgs.values()):
+                        if user_msgs.text and ReUser.get_mentioned(user_msgs.text, new_usernames):
+                            user_msgs.is_changed = True
+        self.frequent_offset = self.messages_offset
+        self.frequent_num_flag_changes = self.num_flag_changes
+        first_msg_time = self.first_msg_time  # time of the first message in the tournament
+
+        def get_last_time(user_msgs):
+            for um in reversed(user_msgs.msgs):
                 if um is not None:
                     return um.time
             return first_msg_time - timedelta(seconds=TIME_FREQUENT_MESSAGES + 999)
 
-        last_user = ""
-        for msg in self.messages:
+        for msg in self.messages[len(self.frequent_msgs):]:
+            self.frequent_msgs.append(msg)
             if msg.is_removed or msg.is_official:
                 continue
             is_to_be_processed = not msg.is_disabled and not msg.is_timed_out  # and not msg.is_deleted
             is_among_first_messages = delta_s(msg.time, first_msg_time) < max(1.0, API_TOURNEY_PAGE_DELAY)
-            keys = list(user_msgs.keys())
-            for username in keys:
-                if not is_to_be_processed or username != last_user:
+            for username, user_msgs in list(self.open_user_msgs.items()):
+                if not is_to_be_processed or username != self.last_user:
                     if not is_among_first_messages \
-                            and delta_s(msg.time, get_last_time(username)) < TIME_FREQUENT_MESSAGES:
-                        if user_msgs[username][-1] is not None:
-                            user_msgs[username].append(None)
+                            and delta_s(msg.time, get_last_time(user_msgs)) < TIME_FREQUENT_MESSAGES:
+                        if user_msgs.msgs[-1] is not None:
+                            user_msgs.msgs.append(None)
+                            user_msgs.is_changed = True
                     else:
-                        process_user(username)
-                        del user_msgs[username]
+                        self.closed_user_msgs.append(user_msgs)
+                        del self.open_user_msgs[username]
             if is_to_be_processed:
-                if msg.username in user_msgs:
-                    user_msgs[msg.username].append(msg)
-                else:
-                    user_msgs[msg.username] = [msg]
-                last_user = msg.username
+                user_msgs = self.open_user_msgs.get(msg.username)
+                if user_msgs is None:
+                    user_msgs = UserMessages(msg.username)
+                    self.open_user_msgs[msg.username] = user_msgs
+                user_msgs.msgs.append(msg)
+                user_msgs.is_changed = True
+                self.user_msgs_by_id[msg.id] = user_msgs
+                self.last_user = msg.username
             else:
-                last_user = ""
-        for username in user_msgs.keys():
-            process_user(username)
-        self.multiline_reports = output
-        return multi_messages, to_timeout
+                self.last_user = ""
+
+    def process_user_messages(self, user_msgs):
+        user_msgs.is_changed = False
+        user_msgs.result = None
+        user_msgs.text = ""
+        msgs = user_msgs.msgs
+        num_not_reset_messages = len([um for um in msgs if um is not None and not um.is_reset])
+        if num_not_reset_messages <= 1:
+            return
+        # Detect messages with unknown time (received at startup)
+        i = 0
+        num_first_messages = 0
+        for um in msgs:
+            if um is not None:
+                if delta_s(um.time, self.first_msg_time) >= max(1.0, API_TOURNEY_PAGE_DELAY):
+                    break
+                num_first_messages += 1
+            i += 1
+        if i > 0 and num_first_messages < NUM_FREQUENT_MESSAGES:
+            msgs = msgs[i:]
+            j = 0
+            for um in msgs:
+                if um is not None:
+                    break
+                j += 1
+            if j > 0:
+                msgs = msgs[j:]
+        real_msgs = [um for um in msgs if (um is not None and um.delay is not None
+                                           and um.text.lower() not in STD_SHORT_MESSAGES)]
+        num_msgs = len(real_msgs)
+        if num_msgs <= 1:
+            return
+        # Only the user names in the combined text can change its evaluation
+        user_msgs.text = " ".join([m.text for m in real_msgs])
+        mentioned_usernames = ReUser.get_mentioned(user_msgs.text, self.re_usernames)
+        key = tuple(None if m is None else m.get_state() for m in msgs), \
+            tuple(re_i.info for re_i in mentioned_usernames)
+        if key != user_msgs.key:
+            output = self.frequent_results.get(key)
+            if output is None:
+                output = self.process_multi_messages(user_msgs.user_name, msgs, real_msgs, user_msgs.text,
+                                                     mentioned_usernames)
+            user_msgs.key = key
+            user_msgs.output = output
+        user_msgs.result = num_msgs, real_msgs, *user_msgs.output
+
+    def process_multi_messages(self, user_name, msgs, real_msgs, combined_text, re_usernames):
+        # Returns the combined message to time out or None and the report (score, header, messages) or None
+        num_msgs = len(real_msgs)
+        msgs_id = real_msgs[-1].id
+        timeout_msg = None
+        # Check how short the messages are and how many
+        score_int = max(0, (num_msgs - 3) * 5) if num_msgs <= 8 else num_msgs * 5
+        if len(real_msgs) >= 3:
+            lengths = [len(um.text) for um in real_msgs]
+            mean_len = (sum(lengths) - max(lengths)) / (len(lengths) - 1)
+            len_real_msgs = len(real_msgs) if self.t_type == TournType.Study else (2 * len(real_msgs) - len(msgs))
+            if len_real_msgs >= 8:
+                coef = 20 if mean_len < 3 else 15 if mean_len < 4 else 10 if mean_len < 5 else 5 if mean_len < 6 \
+                          else 2 if mean_len < 10 else 1.5 if mean_len < 15 else 1
+            elif len_real_msgs >= 5:
+                coef = 5 if mean_len < 3 else 4 if mean_len < 4 else 2 if mean_len < 5 else 1.5 if mean_len < 10 else 1
+            else:
+                coef = 1
+            t_1 = real_msgs[0].time - timedelta(seconds=real_msgs[0].delay)
+            t_9 = real_msgs[min(len(real_msgs) - 1, 9)].time
+            dt = deltaseconds(t_9, t_1)
+            coef_decrease = max(1, min(10, dt / 60))
+            score_int = int(score_int * coef / coef_decrease)
+        combined_msg = Message({'u': user_name, 't': combined_text}, real_msgs[-1].tournament, real_msgs[-1].time)
+        combined_msg.id = -msgs_id  # for recommended_timeouts
+        max_score = max([(0 if m.score is None else m.score) for m in real_msgs])
+        combined_msg.evaluate(re_usernames)
+        best_ban_reason = combined_msg.best_ban_reason()
+        if best_ban_reason != Reason.No or score_int > MULTI_MSG_MIN_TIMEOUT_SCORE:
+            combined_msg.text = f'[multiline] {" | ".join([m.text for m in real_msgs])}'
+            if score_int > MULTI_MSG_MIN_TIMEOUT_SCORE:
+                combined_msg.reasons[Reason.Spam] = score_int / MULTI_MSG_MIN_TIMEOUT_SCORE
+                combined_msg.score = score_int
+                combined_msg.languages |= Lang.Spam
+            else:
+                sum_len = sum([len(m.text) for m in real_msgs]) + len(real_msgs) - 1
+                if sum_len > MAX_LEN_TEXT:
+                    enumerated_msgs = [(i, m) for i, m in enumerate(real_msgs)]
+                    enumerated_msgs.sort(key=lambda im: im[1].score * 999 - len(im[1].text), reverse=True)
+                    reported_msgs = [False] * len(real_msgs)
+                    total_len = 0
+                    last_msg = ""
+                    for i, um in enumerated_msgs:
+                        total_len += len(um.text)
+                        if total_len > MAX_LEN_TEXT and total_len != len(um.text):
+                            last_msg = um.text
+                            break
+                        reported_msgs[i] = True
+                        total_len += 1  # whitespace
+                    combined_msg.text = f'[multiline] ' \
+                                        f'{" | ".join([m.text for i, m in enumerate(real_msgs) if reported_msgs[i]])}'
+                    if last_msg:
+                        combined_msg.text = f"{combined_msg.text} | {last_msg}"  # add to the end to further shorten it
+            timeout_msg = combined_msg
+            if DO_AUTO_TIMEOUTS:
+                return timeout_msg, None
+        # Add scores
+        best_reason = best_ban_reason if best_ban_reason != Reason.No else combined_msg.best_score_reason()
+        final_score = f'<abbr title="{num_msgs} messages in a row or in a short period of time">{score_int}</abbr>'
+        if combined_msg.score > max_score:
+            prev = final_score if score_int > 0 else ""
+            if best_reason != Reason.No:
+                final_score = f'{prev}+<abbr title="{Reason.to_text(best_reason)}">{combined_msg.score}</abbr>'
+            else:
+                final_score = f'{prev}+{combined_msg.score}'
+            score_int += combined_msg.score
+        if score_int < CHAT_FREQUENT_MSGS_MIN_SCORE[0] or (score_int < CHAT_FREQUENT_MSGS_MIN_SCORE[1] and num_msgs < 5):
+            return timeout_msg, None
+        tag = 'B'
+        score_theme = ' class="text-danger"' if score_int > 50 else ' class="text-warning"' if score_int > 10 else ""
+        score = f'<span{score_theme}>{final_score}</span>'
+        user = f'<a class="text-info" href="{get_user_comm_href(user_name)}" target="_blank">{user_name}</a>'
+        button_dismiss = f'<button class="btn btn-primary align-baseline flex-grow-0 px-1 py-0" ' \
+                         f'onclick="set_multi_ok(\'{tag}{msgs_id}\')">Dismiss</button>'
+        if best_reason == Reason.No:
+            best_reason = int(Reason.Spam)
+        r = Reason.to_Tag(best_reason)
+        class_ban = "btn-warning" if combined_msg.score >= 50 else "btn-success"
+        button_ban = f'<button class="btn {class_ban} nav-item dropdown-toggle align-baseline mr-1 px-1 py-0" ' \
+                     f'data-toggle="dropdown" aria-haspopup="true" aria-expanded="false" style="cursor:pointer;">' \
+                     f'Ban</button><span class="dropdown-menu" style="">' \
+                     f'<button class="dropdown-item btn-primary" onclick="timeout_multi(\'{tag}{msgs_id}\', 1);">' \
+                     f'{combined_msg.format_reason(Reason.Shaming, "Public Shaming", Reason.Spam, best_reason)}</button>' \
+                     f'<button class="dropdown-item btn-primary" onclick="timeout_multi(\'{tag}{msgs_id}\', 2);">' \
+                     f'{combined_msg.format_reason(Reason.Offensive, "Offensive Language", Reason.Spam, best_reason)}</button>' \
+                     f'<button class="dropdown-item btn-primary" onclick="timeout_multi(\'{tag}{msgs_id}\', 3);">' \
+                     f'{combined_msg.format_reason(Reason.Spam, "Spamming", Reason.Spam, best_reason)}</button>' \
+                     f'<button class="dropdown-item btn-primary" onclick="timeout_multi(\'{tag}{msgs_id}\', 4);">' \
+                     f'{combined_msg.format_reason(Reason.Other, "Inappropriate Behaviour", Reason.Spam, best_reason)}</button>' \
+                     f'</span>'
+        if best_ban_reason != Reason.No or combined_msg.score >= 50:
+            button_ban = f'<button class="btn btn-danger align-baseline flex-grow-0 py-0 px-1" ' \
+                         f'onclick="timeout_multi(\'{tag}{msgs_id}\', {int(best_reason)});">{r}</button>{button_ban}'
+        header_2 = f'<div class="d-flex justify-content-between mb-1"><span>{button_ban}{user}</span>' \
+                   f'<span class="align-items-baseline ml-1">{score} {button_dismiss}</span></div>'
+        msgs_info = [HR if m is None else m.get_info(tag, show_hidden=True, add_user=False, rename_dismiss="Exclude",
+                                                     add_reason=Reason.Spam) for m in msgs]
+        return timeout_msg, (score_int, header_2, "".join(msgs_info))
 
     def get_list_item(self, now_utc, monitored=False):
         checked = ' checked=""' if monitored or ((self.t_type != TournType.Swiss or CHAT_UPDATE_SWISS)
@@ -9,6 +9,14 @@ MAX_LEN_TOURNEY_NAME_LONG = 35
 NUM_RECENT_BROADCASTS_TO_FETCH = 20
 
 API_TOURNEY_PAGE_DELAY = 1.0  # [s]
+API_CACHE_TTL = 60  # [s]
+API_CACHE_SIZE = 2000
+API_MAX_CLIENTS = 100
+API_CLIENT_IDLE_TIMEOUT = 15 * 60  # [s]
+API_RETRY_AFTER = 60  # [s] if a 429 response has no Retry-After header
+API_ERROR_PAUSE = 2  # [s]
+API_MAX_DELAY_FACTOR = 16
+API_DELAY_RECOVERY = 0.8  # the widened delay of an endpoint is multiplied by it after each successful request
 IDX_NO_PAGE_UPDATE = 0
 API_CHAT_REFRESH_PERIOD = [1, 5, 25, 60]  # [s]
 PERIOD_UPDATE_TOURNAMENTS = 2 * 60  # [s]
@@ -21,6 +29,7 @@ TIMEOUT_RANGE = [25, 25]  # [min]
 DELAY_ERROR_READ_MOD_LOG = 60  # [min]
 DELAY_ERROR_CHAT_404 = 10 * 60   # [s]
 TIME_CHAT_REMOVED_404 = 30 * 60   # [s]
+DELAY_ERROR_CHAT_500 = 60   # [s]
 RECENT_TIMEOUT = 12 * 60 * 60  # [s]
 RECENT_WARNING = 7 * 24 * 60 * 60  # [s]
 LIFETIME_USER_CACHE = 1 * 60 * 60  # [s]
@@ -30,6 +39,16 @@ CHAT_MAX_NUM_MSGS = 990
 CHAT_MAX_NUM_OLD_MSGS = 2500
 CHAT_MSGS_LIFETIME = 2 * 365  # days
 CHAT_FREQUENT_MSGS_MIN_SCORE = [15, 30]
+CHAT_EVAL_CACHE_SIZE = 20000  # evaluated texts
+CHAT_FLAGS_FLUSH_PERIOD = 2  # [s]
+DB_FTS_ROW_COST = 4  # [scanned rows] per match from the full-text index
+DB_DELETE_BATCH_SIZE = 500  # [rows]
+DB_DELETE_PAUSE = 0.1  # [s]
+DB_VACUUM_PAGES = 200
+CHAT_ACTIVITY_PERIOD = 10 * 60  # [s]
+CHAT_BUSY_NUM_MSGS = 10  # messages within CHAT_ACTIVITY_PERIOD
+CHAT_QUIET_UPDATE_PERIOD = 3  # [chat refreshes]
+CHAT_POLL_TIMEOUT = 25  # [s] to wait for changes of the /chat page
 CHAT_BEGINNING_MESSAGES_TEXT = '"name":"Chat room","lines":['
 CHAT_END_MESSAGES_TEXT = '],"resourceType":'
 TOURNEY_STANDING_BEGINNING_TEXT = '"standing":{"page":1,"players":['
@@ -1,8 +1,17 @@
 from peewee import *
-from elements import get_db
+from queue import Queue
+from threading import Thread
+import atexit
+import time
+from math import isqrt
+from elements import get_db, log, log_exception
+from consts import DB_FTS_ROW_COST, DB_DELETE_BATCH_SIZE, DB_DELETE_PAUSE, DB_VACUUM_PAGES
 
 
-db = SqliteDatabase(get_db(), pragmas={'timeout': 20})
+# auto_vacuum=INCREMENTAL applies to new databases only (an existing one would need a full VACUUM) and must
+# precede journal_mode=WAL, which writes the header, synchronous=NORMAL is safe with WAL, cache_size in KiB
+db = SqliteDatabase(get_db(), pragmas={'auto_vacuum': 2, 'journal_mode': 'wal', 'synchronous': 1,
+                                      'cache_size': -16 * 1024, 'timeout': 20})
 
 
 class Mods(Model):
@@ -41,6 +50,132 @@ class Messages(Model):
     class Meta:
         database = db
 
+    @staticmethod
+    def get_tournament_where(tourn_id):
+        # The IDs are case-sensitive, the NOCASE comparison is for the index on (tournament COLLATE NOCASE, time)
+        return (Messages.tournament.collate('NOCASE') == tourn_id) & (Messages.tournament == tourn_id)
+
+
+class WriteQueue:
+    # Runs the DB writes in a background thread in the order they were queued,
+    # all writes queued by the time the thread gets to them in one transaction
+    def __init__(self):
+        self.queue = Queue()
+        Thread(name="db_writer", target=self.run, daemon=True).start()
+
+    def put(self, func, *args):
+        self.queue.put((func, args))
+
+    def join(self):
+        self.queue.join()
+
+    def run(self):
+        while True:
+            writes = [self.queue.get()]
+            while not self.queue.empty():
+                writes.append(self.queue.get())
+            try:
+                with db.atomic():
+                    for func, args in writes:
+                        try:
+                            with db.atomic():
+                                func(*args)
+                        except Exception as exception:
+                            log_exception(exception)
+            except Exception as exception:
+                log_exception(exception)
+            for _ in writes:
+                self.queue.task_done()
+
+
+def create_message_indexes():
+    # Returns whether the full-text index is available and whether it has just been created
+    # The searches compare the user names and the tournament IDs with COLLATE NOCASE, the index entries end with id
+    db.execute_sql('CREATE INDEX IF NOT EXISTS messages_username_time ON messages (username COLLATE NOCASE, time)')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS messages_tournament_time ON messages (tournament COLLATE NOCASE, time)')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS messages_time ON messages (time)')
+    # Full-text index of the texts kept in sync by the triggers, the trigram tokenizer needs SQLite 3.34+
+    try:
+        is_new = not db.table_exists('messages_fts')
+        db.execute_sql("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, content='messages', "
+                       "content_rowid='id', tokenize='trigram case_sensitive 0')")
+        db.execute_sql('CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN '
+                       'INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END')
+        db.execute_sql('CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN '
+                       "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text); END")
+        db.execute_sql('CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN '
+                       "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+                       'INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END')
+        return True, is_new
+    except Exception as exception:
+        log_exception(exception)
+        return False, False
+
+
+def rebuild_fts_index(is_rebuilt):
+    db.execute_sql("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+    is_rebuilt.append(True)
+
+
+def build_fts_index():
+    # Indexes the existing messages in the background: the DB writer runs the rebuild in its transaction,
+    # and text_contains() uses the index once it's committed. The new messages are indexed by the triggers.
+    global has_fts
+    log("Building the full-text index of the messages...", to_print=True, to_save=True)
+    is_rebuilt = []
+    write_queue.put(rebuild_fts_index, is_rebuilt)
+    write_queue.join()
+    has_fts = bool(is_rebuilt)
+    if has_fts:
+        log("The full-text index of the messages is built", to_print=True, to_save=True)
+
+
+def text_contains(text, limit):
+    # Same as Messages.text.contains(text), narrowed down by the full-text index if the text is rare enough:
+    # a frequent text is found faster by scanning the messages in the time order until the limit is reached.
+    # A match from the index costs about DB_FTS_ROW_COST scanned rows, a trigram phrase matches any substring
+    # of at least 3 characters
+    where = Messages.text.contains(text)
+    if not has_fts or len(text) < 3:
+        return where
+    phrase = '"{}"'.format(text.replace('"', '""'))
+    # separate MAX() and MIN() queries are read from the ends of the primary key
+    max_id = Messages.select(fn.MAX(Messages.id)).scalar() or 0
+    num_rows = max_id - (Messages.select(fn.MIN(Messages.id)).scalar() or 0)
+    max_matches = isqrt(max(0, limit) * num_rows // DB_FTS_ROW_COST)
+    num_matches = db.execute_sql('SELECT COUNT(*) FROM (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? '
+                                 'LIMIT ?)', (phrase, max_matches)).fetchone()[0]
+    if num_matches < max_matches:
+        where &= Messages.id.in_(SQL('(SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)', [phrase]))
+    return where
+
+
+def delete_old_messages(old_dt):
+    # Deletes the messages older than old_dt in short transactions found by the time index,
+    # so that the other DB writes wait for one batch at most, and returns the freed pages to the file system
+    try:
+        is_incremental_vacuum = (db.pragma('auto_vacuum') == 2)
+        num_deleted = DB_DELETE_BATCH_SIZE
+        while num_deleted == DB_DELETE_BATCH_SIZE:
+            with db.atomic():
+                old_ids = Messages.select(Messages.id).where(Messages.time < old_dt).limit(DB_DELETE_BATCH_SIZE)
+                num_deleted = Messages.delete().where(Messages.id.in_(old_ids)).execute()
+                if is_incremental_vacuum:
+                    for _ in range(DB_VACUUM_PAGES):  # sqlite3 runs one step of the statement, freeing one page
+                        db.execute_sql('PRAGMA incremental_vacuum(1)')
+            time.sleep(DB_DELETE_PAUSE)
+    except Exception as exception:
+        log_exception(exception)
+    finally:
+        db.close()
+
 
 db.connect()
 db.create_tables([Mods, Authentication, Messages], safe=True)
+has_fts, is_fts_new = create_message_indexes()
+db.execute_sql('PRAGMA optimize')
+write_queue = WriteQueue()
+atexit.register(write_queue.join)
+if is_fts_new:
+    has_fts = False  # until build_fts_index() is done
+    Thread(name="fts_builder", target=build_fts_index, daemon=True).start()
@@ -12,7 +12,7 @@ import base64
 import struct
 from itertools import chain
 from pygal.style import DarkStyle
-from api import ApiType
+from api import ApiType, Api
 from consts import *
 
 
@@ -166,6 +166,10 @@ def get_embed_lichess():
     return os.getenv("EMBED_LICHESS", "False") == "True"
 
 
+def get_metrics_token():
+    return os.getenv("METRICS_TOKEN", "")
+
+
 def needs_to_refresh_insights(user_id, now=None):
     if now is None:
         now = datetime.now()
@@ -730,7 +734,13 @@ class Games:
         url = f"https://lichess.org/api/games/user/{self.user_id}?{rated}{str_perfType}finished=true&max={max_num_games}" \
               f"{moves}&since={since}{str_until}"
         self.since = None if since == ts_Xmonths_ago else since
-        games = mod.api.get_ndjson(ApiType.ApiGamesUser, url, mod.token)
+        # Correspondence games are deleted below unless requested: keep only what's needed to count them
+        to_keep_correspondence = bool(perf_type & PerfType.correspondence)
+        games = []
+        for game in mod.api.iter_ndjson(ApiType.ApiGamesUser, url, mod.token):
+            if not to_keep_correspondence and game['speed'] == "correspondence":
+                game = {'status': game['status'], 'speed': game['speed']}
+            games.append(game)
         if len(games) > self.max_num_games:
             num_to_delete = len(games) - self.max_num_games
             self.games = []
@@ -744,7 +754,7 @@ class Games:
         else:
             self.games = games
         # Delete correspondence games in variants
-        if not (perf_type & PerfType.correspondence):
+        if not to_keep_correspondence:
             for i in range(len(self.games) - 1, -1, -1):
                 if self.games[i]['speed'] == "correspondence":
                     del self.games[i]
@@ -987,7 +997,7 @@ def log_exception(exception, to_print=True, to_save=True):
     log(text, to_print=False, to_save=to_save)
 
 
-def log_read(lines_per_page=100, page=0, reverse=True):
+def log_read(lines_per_page=100, page=0, reverse=True, status=()):
     if lines_per_page < 0 or page < 0:
         return ""
     max_size = 50_000_000
@@ -1005,7 +1015,10 @@ def log_read(lines_per_page=100, page=0, reverse=True):
     lines = all_lines[-offset - lines_per_page:] if offset == 0 else all_lines[-offset - lines_per_page: -offset]
     if reverse:
         lines.reverse()
-    lines.insert(0, f"Version: {LITOOLS_VERSION[1:]}\nLog size: {file_size:,}\nLines: {len(all_lines):,}\n\n")
+    streams = "".join(f"{line}\n" for line in [Api.cache.get_status(), *Api.streams.get_status(),
+                                                         *status])
+    lines.insert(0, f"Version: {LITOOLS_VERSION[1:]}\nLog size: {file_size:,}\nLines: {len(all_lines):,}\n"
+                    f"{streams}\n")
     return html.escape("".join(lines)).replace('\n', "<br>").replace(' ', "&nbsp;")
 
 
@@ -1083,6 +1096,7 @@ def add_note(username, note, mod):
         r = mod.api.post(ApiType.ApiUserNote_Post, url, token=mod.token, json=data)
         if r.status_code == 200:
             log(f"ADD NOTE for @{username}:\n{note}", False, True, 2)
+            mod.api.invalidate(username)
             return True
     except Exception as exception:
         log_exception(exception)
@@ -1511,6 +1525,7 @@ def warn_user(username, subject, mod):
         r = mod.api.post(ApiType.ApiWarn, url, token=mod.token)
         if r.status_code == 200:
             log(f"WARNING @{username}: {subject}", True, True, 2)
+            mod.api.invalidate(username)
             return True
     except Exception as exception:
         log_exception(exception)
@@ -1535,6 +1550,7 @@ def mark_booster(username, mod):
         r = mod.api.post(ApiType.ApiBooster, url, token=mod.token)
         if r.status_code == 200:
             log(f'MARK BOOST: @{username}', True, True, 2)
+            mod.api.invalidate(username)
             return True
     except Exception as exception:
         log_exception(exception)
@@ -1547,6 +1563,7 @@ def close_account(username, mod):
         r = mod.api.post(ApiType.ModCloseAccount, url, token=mod.token)
         if r.status_code == 200:
             log(f'CLOSE ACCOUNT: @{username}', True, True, 2)
+            mod.api.invalidate(username)
             add_note(username, "Closed for username", mod)
             return True
         else:
@@ -0,0 +1,407 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import zlib
+from datetime import datetime, timedelta
+from dateutil import tz
+import chess
+import httpx
+from urllib.parse import urlencode
+from flask import Flask, Response, request, redirect
+from consts import CHAT_BEGINNING_MESSAGES_TEXT, CHAT_END_MESSAGES_TEXT
+
+
+# A local stand-in for lichess.org to run and benchmark litools without sending requests to Lichess:
+#     python fake_lichess.py --port 5050
+#     LICHESS_URL=http://127.0.0.1:5050 TOKEN=fake ROOM_TOKEN=fake python app.py
+# Responses are replayed from the fixtures (if recorded) or generated: deterministic for the same URL,
+# the chats of the tournaments get new messages over time.
+# With --record, the requests are forwarded to lichess.org and the responses are saved as fixtures.
+# The generated data doesn't give the mod rights that depend on private notes, recorded fixtures do.
+
+app = Flask(__name__)
+settings = argparse.Namespace(fixtures="./fixtures", record=False, latency=0, tournaments=20, rate=20, games=500)
+LICHESS_URL = "https://lichess.org"
+EXPLORER_URL = "https://explorer.lichess.ovh"
+start_time = time.time()
+usernames = [f"{prefix}{i}" for i, prefix in enumerate(["Player", "chess_fan", "Knight", "pawnstorm", "GM_wannabe",
+                                                       "blitzer", "Rook", "queen_of_e4", "Bishop", "zugzwang"] * 30)]
+chat_texts = ["hi", "gl all", "gg", "good game", "wow", "nice", "lol", "anyone wants to play?", "what time is it",
+              "I lost on time again", "this opening is so bad", "hello from Brazil", "who is winning?", "gg wp",
+              "why so many berserks", "check out my stream https://twitch.tv/someone", "aaaaaaaaaaaaa",
+              "you are so bad", "noob", "follow me pls", "привет всем", "hola", "🔥🔥🔥", "!!!!!!!!!!", "ez",
+              "I hate this", "how do I join a team?", "is this rated?", "1.e4 best by test", "gg everyone"]
+re_fixture_name = re.compile(r"[^\w.-]+")
+
+
+def get_random(*keys):
+    return random.Random(zlib.crc32("/".join(str(key) for key in keys).encode()))
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def ndjson(items):
+    return Response((f"{json.dumps(item)}\n" for item in items), mimetype="application/x-ndjson")
+
+
+def get_fixture_file():
+    name = re_fixture_name.sub("_", f"{request.method} {request.path}").strip("_")
+    query = request.query_string.decode()
+    if request.method == "POST" and request.data:
+        query = f"{query}{request.data.decode(errors='replace')}"
+    if query:
+        name = f"{name}_{hashlib.sha1(query.encode()).hexdigest()[:10]}"
+    return os.path.join(settings.fixtures, f"{name[:150]}.json")
+
+
+def record(fixture_file):
+    base_url = EXPLORER_URL if request.path.startswith("/explorer/") else LICHESS_URL
+    path = request.full_path[len("/explorer"):] if base_url == EXPLORER_URL else request.full_path
+    headers = {key: value for key, value in request.headers.items()
+               if key in ["Authorization", "Accept", "Content-Type", "User-Agent"]}
+    r = httpx.request(request.method, f"{base_url}{path.rstrip('?')}", headers=headers, content=request.data,
+                      follow_redirects=True, timeout=60)
+    fixture = {'status': r.status_code, 'content_type': r.headers.get('Content-Type', "application/json"),
+               'body': r.text}
+    os.makedirs(settings.fixtures, exist_ok=True)
+    with open(fixture_file, "w", encoding="utf-8") as file:
+        json.dump(fixture, file, ensure_ascii=False)
+    return fixture
+
+
+@app.before_request
+def replay():
+    if settings.latency:
+        time.sleep(settings.latency / 1000)
+    fixture_file = get_fixture_file()
+    if settings.record:
+        fixture = record(fixture_file)
+    elif os.path.exists(fixture_file):
+        with open(fixture_file, encoding="utf-8") as file:
+            fixture = json.load(file)
+    else:
+        return None
+    return Response(fixture['body'], status=fixture['status'], content_type=fixture['content_type'])
+
+
+# Account and mod tools
+
+@app.route("/api/account")
+def account():
+    return {'id': "fakemod", 'username': "FakeMod"}
+
+
+@app.route("/oauth")
+def oauth():
+    # The mod accepts at once
+    params = {'code': "fakecode", 'state': request.args.get('state', "")}
+    return redirect(f"{request.args.get('redirect_uri', '')}?{urlencode(params)}")
+
+
+@app.route("/api/token", methods=['POST', 'DELETE'])
+def token():
+    if request.method == "DELETE":
+        return Response(status=204)
+    return {'token_type': "Bearer", 'access_token': "lio_ZmFrZS10b2tlbi1mb3ItbGl0b29scy0x",
+            'expires_in': 365 * 24 * 60 * 60}
+
+
+def get_mod_log(username):
+    rnd = get_random("mod-log", username.lower())
+    actions = []
+    t = now_ms()
+    for i in range(rnd.randint(0, 8)):
+        t -= rnd.randint(1, 100) * 24 * 60 * 60 * 1000
+        action = rnd.choice(["chatTimeout", "modMessage", "troll", "untroll", "booster", "alt"])
+        details = rnd.choice(["spam", "insult", "shaming", "other"]) if action == "chatTimeout" else \
+            rnd.choice(["Warning: Spam is not permitted", "Warning: Boosting"]) if action == "modMessage" else ""
+        actions.append({'mod': rnd.choice(["fakemod", "lichess"]), 'action': action, 'date': t, 'details': details})
+    return actions
+
+
+@app.route("/mod/chat-user/<username>")
+def chat_user(username):
+    # "tv" is used to check the timeout permission
+    history = [{'mod': "fakemod", 'date': now_ms(), 'reason': "spam"}] if username == "tv" else \
+        [{'mod': a['mod'], 'date': a['date'], 'reason': a['details']}
+         for a in get_mod_log(username) if a['action'] == "chatTimeout"]
+    return {'history': history}
+
+
+@app.route("/api/user/<username>/mod-log")
+def mod_log(username):
+    return {'logs': [get_mod_log(username)], 'notes': []}
+
+
+@app.route("/api/user/<username>/note", methods=['GET', 'POST'])
+def notes(username):
+    if request.method == "POST":
+        return {}
+    rnd = get_random("notes", username.lower())
+    return [{'from': {'name': "FakeMod"}, 'text': f"Note {i + 1} about @{username}", 'mod': True,
+             'date': now_ms() - rnd.randint(1, 1000) * 60 * 60 * 1000} for i in range(rnd.randint(0, 3))]
+
+
+@app.route("/mod/public-chat/timeout", methods=['POST'])
+@app.route("/mod/<username>/warn", methods=['POST'])
+@app.route("/mod/<username>/kid", methods=['POST'])
+@app.route("/mod/<username>/troll/<value>", methods=['POST'])
+@app.route("/mod/<username>/booster/<value>", methods=['POST'])
+@app.route("/mod/<username>/close", methods=['POST'])
+@app.route("/api/warn", methods=['POST'])
+def mod_action(username=None, value=None):
+    return {'ok': True}
+
+
+@app.route("/report/list/boost")
+def report_list_boost():
+    return Response("<html><body></body></html>", mimetype="text/html")
+
+
+@app.route("/mod/search")
+def mod_search():
+    return Response("<html><body><table></table></body></html>", mimetype="text/html")
+
+
+# Users
+
+def get_user(username):
+    rnd = get_random("user", username.lower())
+    created_at = now_ms() - rnd.randint(30, 3000) * 24 * 60 * 60 * 1000
+    perfs = {}
+    num_games = 0
+    for perf in ["bullet", "blitz", "rapid", "classical", "correspondence", "chess960", "atomic", "puzzle"]:
+        if rnd.random() < 0.6:
+            games = rnd.randint(1, 3000)
+            num_games += 0 if perf == "puzzle" else games
+            perfs[perf] = {'games': games, 'rating': rnd.randint(800, 2600), 'rd': rnd.randint(45, 150),
+                           'prog': rnd.randint(-50, 50), **({'prov': True} if games < 10 else {})}
+    return {'id': username.lower(), 'username': username, 'perfs': perfs, 'createdAt': created_at,
+            'seenAt': now_ms() - rnd.randint(0, 30 * 24 * 60) * 60 * 1000,
+            'count': {'all': num_games, 'rated': num_games * 9 // 10},
+            'profile': {'bio': f"Hi, I'm {username}", 'flag': rnd.choice(["BR", "DE", "IN", "US", "_earth"])}}
+
+
+@app.route("/api/user/<username>")
+def user(username):
+    return get_user(username)
+
+
+@app.route("/api/users", methods=['POST'])
+def users():
+    return [get_user(username) for username in request.get_data(as_text=True).split(",") if username]
+
+
+@app.route("/api/users/status")
+def users_status():
+    return [{'id': username.lower(), 'name': username} for username in request.args.get('ids', "").split(",")]
+
+
+@app.route("/api/team/of/<username>")
+def teams_of(username):
+    return []
+
+
+@app.route("/@/<username>/following")
+def following(username):
+    return Response("<html><body></body></html>", mimetype="text/html")
+
+
+@app.route("/player/top/<int:nb>/<variant>")
+def leaderboard(nb, variant):
+    rnd = get_random("top", variant)
+    names = rnd.sample(usernames, min(nb, len(usernames)))
+    return {'users': [{'id': name.lower(), 'username': name,
+                       'perfs': {variant: {'rating': 2900 - i * 3, 'progress': rnd.randint(-20, 20)}}}
+                      for i, name in enumerate(names)]}
+
+
+# Games
+
+def get_game(username, i, t, rnd, with_moves):
+    opponent = rnd.choice(usernames)
+    speed, initial, increment = rnd.choice([("bullet", 60, 0), ("blitz", 180, 2), ("blitz", 300, 0),
+                                            ("rapid", 600, 5), ("classical", 1800, 20)])
+    is_white = rnd.random() < 0.5
+    moves = []
+    board = chess.Board()
+    for _ in range(rnd.randint(2, 120)):
+        legal_moves = list(board.legal_moves)
+        if not legal_moves:
+            break
+        move = rnd.choice(legal_moves)
+        moves.append(board.san(move))
+        board.push(move)
+    status = "mate" if board.is_checkmate() else rnd.choice(["resign", "outoftime", "resign", "draw", "timeout"])
+    winner = None if status == "draw" else ("white" if len(moves) % 2 else "black") if status == "mate" \
+        else rnd.choice(["white", "black"])
+    players = {
+        'white' if is_white else 'black': {'user': {'name': username, 'id': username.lower()},
+                                           'rating': rnd.randint(1200, 2200), 'ratingDiff': rnd.randint(-8, 8)},
+        'black' if is_white else 'white': {'user': {'name': opponent, 'id': opponent.lower()},
+                                           'rating': rnd.randint(1200, 2200), 'ratingDiff': rnd.randint(-8, 8)}}
+    game = {'id': f"{rnd.getrandbits(40):010x}"[:8], 'rated': rnd.random() < 0.9,
+            'variant': "standard", 'speed': speed, 'perf': speed, 'createdAt': t, 'lastMoveAt': t + 60_000,
+            'status': status, 'players': players, 'clock': {'initial': initial, 'increment': increment,
+                                                            'totalTime': initial + 40 * increment}}
+    if winner:
+        game['winner'] = winner
+    if with_moves:
+        game['moves'] = " ".join(moves)
+    return game
+
+
+@app.route("/api/games/user/<username>")
+def games(username):
+    max_num = min(int(request.args.get('max', settings.games)), settings.games)
+    with_moves = request.args.get('moves', "true") != "false"
+    until = int(request.args.get('until', now_ms()))
+    since = int(request.args.get('since', 0))
+
+    def generate():
+        rnd = get_random("games", username.lower())
+        t = until
+        for i in range(max_num):
+            t -= rnd.randint(1, 24 * 60) * 60 * 1000
+            if t < since:
+                return
+            yield get_game(username, i, t, rnd, with_moves)
+
+    return ndjson(generate())
+
+
+@app.route("/explorer/lichess")
+def explorer():
+    rnd = get_random("explorer", request.args.get('fen', ""), request.args.get('ratings', ""))
+    board = chess.Board(request.args.get('fen')) if request.args.get('fen') else chess.Board()
+    moves = []
+    for move in list(board.legal_moves)[:rnd.randint(0, 6)]:
+        moves.append({'uci': move.uci(), 'san': board.san(move), 'white': rnd.randint(0, 5000),
+                      'draws': rnd.randint(0, 500), 'black': rnd.randint(0, 5000),
+                      'averageRating': rnd.randint(1200, 2200)})
+    return {'white': sum(m['white'] for m in moves), 'draws': sum(m['draws'] for m in moves),
+            'black': sum(m['black'] for m in moves), 'moves': moves, 'topGames': [], 'opening': None}
+
+
+@app.route("/insights/refresh/<username>", methods=['POST'])
+def insights_refresh(username):
+    return {}
+
+
+@app.route("/insights/data/<username>", methods=['POST'])
+def insights_data(username):
+    query = request.get_json(silent=True) or {}
+    rnd = get_random("insights", username.lower(), json.dumps(query, sort_keys=True))
+    if query.get('dimension') == "date":
+        now = int(time.time())
+        categories = [now - (30 - i) * 7 * 24 * 60 * 60 for i in range(30)]
+    else:
+        categories = ["Sicilian Defense", "French Defense", "Italian Game", "Queen's Gambit", "Caro-Kann Defense"]
+    return {'xAxis': {'categories': categories},
+            'sizeSerie': {'data': [rnd.randint(0, 50) for _ in categories]},
+            'series': [{'data': [rnd.randint(1000, 2400) for _ in categories]}]}
+
+
+# Tournaments and chats
+
+def get_arena(i):
+    # All arenas are running for a day after the start of the server
+    rnd = get_random("arena", i)
+    starts_at = datetime.fromtimestamp(start_time, tz=tz.tzutc()) - timedelta(minutes=rnd.randint(0, 30))
+    finishes_at = datetime.fromtimestamp(start_time, tz=tz.tzutc()) + timedelta(days=1)
+    return {'id': f"fk{i:06d}", 'createdBy': "lichess" if i % 2 == 0 else rnd.choice(usernames),
+            'nbPlayers': rnd.randint(10, 3000), 'fullName': f"Fake {rnd.choice(['Blitz', 'Bullet', 'Rapid'])} Arena",
+            'startsAt': int(starts_at.timestamp() * 1000), 'finishesAt': int(finishes_at.timestamp() * 1000),
+            'minutes': int((finishes_at - starts_at).total_seconds() // 60), 'status': 20}
+
+
+def get_chat_lines(tourn_id, max_lines=100):
+    # Each tournament gets a message every 60/rate seconds on average
+    num = int((time.time() - start_time) * settings.rate / 60) + 5
+    lines = []
+    for k in range(max(0, num - max_lines), num):
+        rnd = get_random("chat", tourn_id, k)
+        lines.append({'u': rnd.choice(usernames), 't': rnd.choice(chat_texts)})
+    return lines
+
+
+@app.route("/api/tournament")
+def arenas():
+    return {'created': [], 'started': [get_arena(i) for i in range(settings.tournaments)], 'finished': []}
+
+
+@app.route("/api/team/<team_id>/arena")
+@app.route("/api/team/<team_id>/swiss")
+def team_tournaments(team_id):
+    return ndjson([])
+
+
+@app.route("/api/broadcast")
+def broadcasts():
+    return ndjson([])
+
+
+@app.route("/api/tournament/<tourn_id>")
+def arena(tourn_id):
+    i = int(tourn_id[2:]) if tourn_id.startswith("fk") and tourn_id[2:].isdigit() else 0
+    return {**get_arena(i), 'id': tourn_id}
+
+
+@app.route("/api/swiss/<tourn_id>")
+def swiss(tourn_id):
+    return {'id': tourn_id, 'createdBy': "lichess", 'nbPlayers': 50, 'name': "Fake Swiss",
+            'startsAt': datetime.fromtimestamp(start_time, tz=tz.tzutc()).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'status': "started"}
+
+
+@app.route("/api/tournament/<tourn_id>/results")
+@app.route("/api/swiss/<tourn_id>/results")
+def results(tourn_id):
+    rnd = get_random("results", tourn_id)
+    names = rnd.sample(usernames, 50)
+    return ndjson({'rank': i + 1, 'score': 100 - i, 'rating': rnd.randint(1200, 2500), 'username': name,
+                   'performance': rnd.randint(1200, 2500), 'points': 10 - i / 10} for i, name in enumerate(names))
+
+
+@app.route("/api/room/<tourn_id>/chat")
+def room_chat(tourn_id):
+    lines = get_chat_lines(tourn_id)
+    users = {line['u'].lower(): {'name': line['u']} for line in lines}
+    return {'users': users, 'lines': [{'user': line['u'].lower(), 'text': line['t']} for line in lines]}
+
+
+@app.route("/tournament/<tourn_id>")
+@app.route("/swiss/<tourn_id>")
+def tournament_page(tourn_id):
+    lines = json.dumps(get_chat_lines(tourn_id), ensure_ascii=False)[1:-1]
+    page = f'<html><body><script>{{"chat":{{"data":{{"id":"{tourn_id}",' \
+           f'{CHAT_BEGINNING_MESSAGES_TEXT}{lines}{CHAT_END_MESSAGES_TEXT}"tournament"}}}}}}</script></body></html>'
+    return Response(page, mimetype="text/html")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for lichess.org")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--fixtures", default=settings.fixtures, help="folder of the recorded responses")
+    parser.add_argument("--record", action="store_true", help="forward requests to lichess.org and save responses")
+    parser.add_argument("--latency", type=int, default=settings.latency, help="added to each response [ms]")
+    parser.add_argument("--tournaments", type=int, default=settings.tournaments, help="number of active arenas")
+    parser.add_argument("--rate", type=float, default=settings.rate, help="chat messages per minute per tournament")
+    parser.add_argument("--games", type=int, default=settings.games, help="max number of games per user export")
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        setattr(settings, key, value)
+    print(f"Fake Lichess at http://{args.host}:{args.port}: {args.tournaments} arenas"
+          f"{', recording' if args.record else ''}")
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 from dateutil import tz
 from functools import partial
 from collections import defaultdict
+from itertools import chain
 from elements import log, log_exception, get_user, get_user_link
 from api import ApiType
 import chess
@@ -362,10 +363,11 @@ def download_games(mod, variants, username, num_games, date_begin, date_end, rat
     elif color == 2:
         params['color'] = "black"
     url = f"https://lichess.org/api/games/user/{username}"
-    games = mod.api.get_ndjson(ApiType.ApiGamesUser, url, mod.token, params=params)
-    if not games:
+    games = mod.api.iter_ndjson(ApiType.ApiGamesUser, url, mod.token, params=params)
+    first_game = next(games, None)
+    if first_game is None:
         raise Exception("No games")
-    return games
+    return chain([first_game], games)
 
 
 def analyze_footprints(mod, variants, username, num_games, date_begin, date_end, rated, color):
@@ -0,0 +1,106 @@
+from threading import Lock
+from bisect import bisect_left
+
+
+TIME_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # [s]
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)  # [bytes]
+
+
+def format_labels(label_names, labels):
+    if not label_names:
+        return ""
+    pairs = []
+    for name, value in zip(label_names, labels):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return f'{{{",".join(pairs)}}}'
+
+
+class Counter:
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.lock = Lock()
+        self.values = {}
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def export(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, label_names=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = Lock()
+        self.values = {}  # labels -> [counts per bucket + "+Inf", sum]
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(labels)
+            if data is None:
+                data = [[0] * (len(self.buckets) + 1), 0]
+                self.values[labels] = data
+            data[0][i] += 1
+            data[1] += value
+
+    def export(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        label_names = (*self.label_names, "le")
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                count = 0
+                for bucket, num in zip((*self.buckets, "+Inf"), counts):
+                    count += num
+                    lines.append(f"{self.name}_bucket{format_labels(label_names, (*labels, bucket))} {count}")
+                str_labels = format_labels(self.label_names, labels)
+                lines.append(f"{self.name}_sum{str_labels} {total}")
+                lines.append(f"{self.name}_count{str_labels} {count}")
+        return lines
+
+
+API_QUEUE_WAIT = Histogram("litools_api_queue_wait_seconds", "Time spent waiting for a rate limiter slot",
+                           ("endpoint",))
+API_LATENCY = Histogram("litools_api_request_duration_seconds", "Duration of Lichess API requests",
+                        ("endpoint", "method"))
+API_RESPONSE_SIZE = Histogram("litools_api_response_size_bytes", "Size of Lichess API responses",
+                              ("endpoint",), SIZE_BUCKETS)
+API_RESPONSES = Counter("litools_api_responses_total", "Lichess API responses by status code",
+                        ("endpoint", "status"))
+API_RETRIES = Counter("litools_api_retries_total", "Retried Lichess API requests", ("endpoint", "reason"))
+API_THROTTLED = Counter("litools_api_throttled_total", "Lichess API responses with status 429", ("endpoint",))
+API_ERRORS = Counter("litools_api_errors_total", "Lichess API requests failed with an exception",
+                     ("endpoint", "error"))
+API_CACHE = Counter("litools_api_cache_total", "Lichess API GET requests served by the cache or an identical "
+                    "request in flight", ("result",))
+NDJSON_QUEUE_WAIT = Histogram("litools_ndjson_queue_wait_seconds", "Time spent waiting for the NDJSON stream "
+                              "of the same token")
+CHAT_EVAL_CACHE = Counter("litools_chat_eval_cache_total", "Chat messages evaluated or taken from the cache",
+                          ("result",))
+CHAT_UPDATE_DURATION = Histogram("litools_chat_update_duration_seconds", "Duration of the stages of the chat updates",
+                                 ("stage",))
+CHAT_LOOP_ITERATIONS = Counter("litools_chat_loop_iterations_total", "Iterations of the chat loop")
+CHAT_LOOP_DURATION = Histogram("litools_chat_loop_duration_seconds", "Duration of the chat loop iterations "
+                               "excluding the waiting time")
+
+all_metrics = [API_QUEUE_WAIT, API_LATENCY, API_RESPONSE_SIZE, API_RESPONSES, API_RETRIES, API_THROTTLED,
+               API_ERRORS, API_CACHE, NDJSON_QUEUE_WAIT, CHAT_EVAL_CACHE, CHAT_UPDATE_DURATION,
+               CHAT_LOOP_ITERATIONS, CHAT_LOOP_DURATION]
+
+
+def export_metrics():
+    lines = []
+    for metric in all_metrics:
+        lines.extend(metric.export())
+    return "\n".join(lines) + "\n"
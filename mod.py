@@ -92,6 +92,7 @@ class Mod:
 
     def set_public_data(self):
         self.id, self.name = self.get_public_data()
+        self.api.owner = self.id
 
     def logout(self):
         if not self.current_session or not self.id or not self.name: